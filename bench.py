@@ -0,0 +1,317 @@
+"""
+Load benchmark for Aura's AI paths that needs no Discord connection and no Gemini quota.
+
+It replays chat traffic through tt.on_message and the /summarize, /brainstorm and
+/plan_my_day handlers. The Discord objects are fakes, and tt.py runs with
+AI_BACKEND=fake (see fake_ai.py). The traffic is either synthetic (Poisson arrivals,
+skewed toward a few busy users, with repeated prompts) or a recorded JSONL trace:
+
+    {"at": 0.42, "kind": "chat", "user": 7, "guild": 2, "text": "hi aura"}
+
+Reports throughput, p50/p95/p99 latency per kind, and memory growth.
+
+    python bench.py --events 500 --rate 25
+    python bench.py --trace traffic.jsonl --speed 4 --latency-ms 300 --error-rate 0.05
+"""
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import random
+import resource
+import time
+import tracemalloc
+from collections import defaultdict
+
+import discord
+
+PROMPTS = [
+    "hi", "hey aura", "thanks!", "good morning", "lol", "what's up",
+    "why is the sky blue?", "explain how a hash map works step by step",
+    "can you help me write a cover letter for a junior developer role?",
+    "compare python and rust for writing a discord bot",
+    "what should I cook tonight with rice, eggs and spinach?",
+    "solve 3x + 7 = 22 and show your work",
+]
+COMMAND_ARGS = {
+    'summarize': ('text', [
+        "The mitochondria is the powerhouse of the cell. It produces ATP through respiration.",
+        "Discord bots receive events over a websocket gateway and reply through the REST API.",
+    ]),
+    'brainstorm': ('topic', ["a birthday party theme", "names for a study group", "weekend side projects"]),
+    'plan_my_day': ('goals', ["gym, finish report, call mom", "study for exams and do laundry"]),
+}
+KIND_WEIGHTS = {'chat': 0.7, 'summarize': 0.1, 'brainstorm': 0.1, 'plan_my_day': 0.1}
+
+_ids = itertools.count(1)
+
+
+# --- FAKE DISCORD OBJECTS ---
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.name = self.display_name = f"user{user_id}"
+        self.mention = f"<@{user_id}>"
+        self.roles = []
+        self.bot = False
+
+    def mentioned_in(self, message) -> bool:
+        return False
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.name = f"guild{guild_id}"
+
+    def get_role(self, role_id):
+        return None
+
+
+class FakeMessage:
+    def __init__(self, channel, author, content=None, embed=None):
+        self.id = next(_ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content or ""
+        self.embeds = [embed] if embed else []
+        self.attachments = []
+        self.mentions = []
+
+    async def reply(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    async def edit(self, content=None, embed=None, **kwargs):
+        self.channel.stats['edits'] += 1
+        if content is not None:
+            self.content = content
+
+    async def delete(self):
+        self.channel.stats['deleted'] += 1
+
+    async def add_reaction(self, emoji):
+        self.channel.stats['reactions'] += 1
+
+    async def remove_reaction(self, emoji, member):
+        pass
+
+
+class FakeChannel:
+    def __init__(self, guild: FakeGuild, name: str, stats: dict):
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = name
+        self.stats = stats
+
+    def typing(self):
+        return contextlib.nullcontext()
+
+    async def send(self, content=None, embed=None, **kwargs):
+        self.stats['sent'] += 1
+        return FakeMessage(self, BOT_USER, content, embed)
+
+
+class FakeInteractionResponse:
+    def __init__(self, interaction):
+        self._interaction = interaction
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def defer(self, **kwargs):
+        self._done = True
+
+    async def send_message(self, content=None, embed=None, **kwargs):
+        self._done = True
+        self._interaction._original = await self._interaction.channel.send(content, embed=embed)
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self._interaction = interaction
+
+    async def send(self, content=None, embed=None, wait=False, **kwargs):
+        return await self._interaction.channel.send(content, embed=embed)
+
+
+class FakeInteraction(discord.Interaction):
+    # Subclassed because stream_long_response and friends check isinstance(..., discord.Interaction).
+    # discord.Interaction.__init__ needs a gateway payload and a ConnectionState, so it is
+    # not called and its slots stay empty. Everything tt.py reads from an interaction is
+    # overridden below; anything else raises AttributeError instead of going unnoticed.
+    def __init__(self, user: FakeUser, channel: FakeChannel):
+        self.id = next(_ids)
+        self._fake_user = user
+        self._fake_channel = channel
+        self._fake_response = FakeInteractionResponse(self)
+        self._fake_followup = FakeFollowup(self)
+        self._fake_created_at = discord.utils.utcnow()
+        self._original = None
+
+    user = property(lambda self: self._fake_user)
+    guild = property(lambda self: self._fake_channel.guild)
+    guild_id = property(lambda self: self._fake_channel.guild.id)
+    channel = property(lambda self: self._fake_channel)
+    channel_id = property(lambda self: self._fake_channel.id)
+    response = property(lambda self: self._fake_response)
+    followup = property(lambda self: self._fake_followup)
+    created_at = property(lambda self: self._fake_created_at)
+
+    async def original_response(self):
+        return self._original
+
+
+BOT_USER = FakeUser(0)
+
+
+# --- TRAFFIC ---
+def synthetic_traffic(events: int, rate: float, users: int, guilds: int, seed: int) -> list:
+    rng = random.Random(seed)
+    user_weights = [1 / (n + 1) for n in range(users)]
+    kinds, kind_weights = zip(*KIND_WEIGHTS.items())
+    at, traffic = 0.0, []
+    for _ in range(events):
+        at += rng.expovariate(rate)
+        user = rng.choices(range(1, users + 1), user_weights)[0]
+        kind = rng.choices(kinds, kind_weights)[0]
+        text = rng.choice(PROMPTS if kind == 'chat' else COMMAND_ARGS[kind][1])
+        traffic.append({'at': at, 'kind': kind, 'user': user, 'guild': user % guilds + 1, 'text': text})
+    return traffic
+
+
+def load_trace(path: str) -> list:
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(samples: list, pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(pct * len(ordered)))]
+
+
+async def wait_for_burst(burst):
+    # Debounced chat messages are answered from a background task that a newer message
+    # may cancel and replace, so follow the burst to whichever task finally answers it.
+    while burst is not None:
+        task = burst['task']
+        try:
+            await asyncio.shield(task)
+            return
+        except asyncio.CancelledError:
+            if not task.cancelled() or burst['task'] is task:
+                raise
+
+
+async def replay(tt, traffic: list, speed: float) -> dict:
+    stats = defaultdict(int)
+    guilds, channels, users = {}, {}, {}
+    latencies = defaultdict(list)
+    failures = defaultdict(int)
+
+    def channel_for(guild_id: int) -> FakeChannel:
+        if guild_id not in channels:
+            guilds[guild_id] = FakeGuild(guild_id)
+            channels[guild_id] = FakeChannel(guilds[guild_id], tt.CHAT_CHANNEL_NAME, stats)
+        return channels[guild_id]
+
+    async def run(event):
+        channel = channel_for(event['guild'])
+        user = users.setdefault(event['user'], FakeUser(event['user']))
+        started = time.perf_counter()
+        try:
+            if event['kind'] == 'chat':
+                await tt.on_message(FakeMessage(channel, user, event['text']))
+                await wait_for_burst(tt.chat_bursts.get((channel.id, user.id)))
+            else:
+                command = getattr(tt, event['kind'])
+                arg_name = COMMAND_ARGS[event['kind']][0]
+                await command.callback(FakeInteraction(user, channel), **{arg_name: event['text']})
+        except Exception as e:
+            failures[event['kind']] += 1
+            print(f"{event['kind']} handler raised: {e!r}")
+        latencies[event['kind']].append(time.perf_counter() - started)
+
+    start = time.perf_counter()
+    tasks = []
+    for event in traffic:
+        delay = event['at'] / speed - (time.perf_counter() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(run(event)))
+    await asyncio.gather(*tasks)
+    return {'wall': time.perf_counter() - start, 'latencies': latencies, 'failures': failures, 'discord': stats}
+
+
+def report(tt, fake_ai, result: dict, mem_before: int, mem_after: int, mem_peak: int):
+    wall = result['wall']
+    everything = [s for samples in result['latencies'].values() for s in samples]
+    print(f"\nEvents: {len(everything)} in {wall:.1f}s -> {len(everything) / wall:.1f} events/s")
+    print(f"{'kind':<12} {'count':>6} {'fail':>5} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for kind, samples in sorted(result['latencies'].items()) + [('all', everything)]:
+        failed = sum(result['failures'].values()) if kind == 'all' else result['failures'][kind]
+        print(f"{kind:<12} {len(samples):>6} {failed:>5} "
+              + " ".join(f"{percentile(samples, p) * 1000:>6.0f}ms" for p in (0.5, 0.95, 0.99)))
+
+    d = result['discord']
+    print(f"\nDiscord: {d['sent']} messages sent, {d['edits']} edits, {d['reactions']} reactions | Dispatcher: {tt.OUTBOUND.stats()}")
+    fs = fake_ai.FAKE_AI_STATS
+    print(f"AI backend: {fs['calls']} calls ({fs['streamed']} streamed), {fs['errors']} injected 503s, "
+          f"{fs['rate_limited']} injected 429s, {fs['prompt_tokens']} prompt / {fs['reply_tokens']} reply tokens")
+    print(f"Scheduler: {tt.AI_SCHEDULER.stats()}")
+    print(f"Hedging: {tt.HEDGE_STATS} | Retries: {tt.RETRY_STATS} | Debounce: {tt.DEBOUNCE_STATS}")
+    print(f"Response cache: {tt.RESPONSE_CACHE.stats()} | Coalescing: {tt.AI_SINGLE_FLIGHT.stats()}")
+    footprint = tt.conversation_history.footprint()
+    print(f"Conversation store: {footprint}")
+    print(f"\nMemory: traced {mem_before / 1048576:.1f} MiB -> {mem_after / 1048576:.1f} MiB "
+          f"(+{(mem_after - mem_before) / 1048576:.1f} MiB, peak {mem_peak / 1048576:.1f} MiB), "
+          f"max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay chat traffic through Aura against the offline AI backend.")
+    parser.add_argument('--trace', help="JSONL trace to replay instead of synthetic traffic")
+    parser.add_argument('--save-trace', help="write the synthetic traffic to this JSONL file")
+    parser.add_argument('--events', type=int, default=300)
+    parser.add_argument('--rate', type=float, default=20, help="synthetic arrivals per second")
+    parser.add_argument('--users', type=int, default=40)
+    parser.add_argument('--guilds', type=int, default=4)
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed multiplier")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency-ms', type=float, help="fake backend median latency")
+    parser.add_argument('--error-rate', type=float, help="fake backend injected 503 rate")
+    parser.add_argument('--rate-limit-rate', type=float, help="fake backend injected 429 rate")
+    args = parser.parse_args()
+
+    # fake_ai and tt read their settings at import time.
+    os.environ['AI_BACKEND'] = 'fake'
+    os.environ.setdefault('FAKE_AI_SEED', str(args.seed))
+    for flag, env in (('latency_ms', 'FAKE_AI_LATENCY_MEDIAN_MS'), ('error_rate', 'FAKE_AI_ERROR_RATE'),
+                      ('rate_limit_rate', 'FAKE_AI_RATE_LIMIT_RATE')):
+        if getattr(args, flag) is not None:
+            os.environ[env] = str(getattr(args, flag))
+
+    import tt
+    import fake_ai
+    tt.bot._connection.user = BOT_USER
+
+    traffic = load_trace(args.trace) if args.trace else synthetic_traffic(args.events, args.rate, args.users, args.guilds, args.seed)
+    if args.save_trace:
+        with open(args.save_trace, 'w') as f:
+            f.writelines(json.dumps(event) + "\n" for event in traffic)
+
+    tracemalloc.start()
+    mem_before = tracemalloc.get_traced_memory()[0]
+    result = asyncio.run(replay(tt, traffic, args.speed))
+    mem_after, mem_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    report(tt, fake_ai, result, mem_before, mem_after, mem_peak)
+
+
+if __name__ == "__main__":
+    main()
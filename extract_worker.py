@@ -0,0 +1,69 @@
+"""
+yt-dlp extraction worker for the bot's ExtractionPool (see tt.py).
+
+The pool starts each worker as its own process with
+`python extract_worker.py '<option sets as JSON>'`, so a worker imports yt-dlp and
+nothing from the bot. It reads one JSON request per line on stdin:
+
+    {"query": "ytsearch1:...", "opts": {...}}
+
+and answers each one with a single JSON line on stdout, either
+{"info": {...}, "seconds": 1.2} or {"error": "..."}. A worker keeps one YoutubeDL
+instance per option set and reuses it across requests. The option sets passed on
+the command line are built, with their cookie files loaded, before the first
+request arrives. The worker exits when its stdin closes.
+"""
+import json
+import sys
+import time
+
+import yt_dlp
+
+_instances = {}
+
+
+def _instance(ydl_opts: dict) -> yt_dlp.YoutubeDL:
+    key = json.dumps(ydl_opts, sort_keys=True)
+    ydl = _instances.get(key)
+    if ydl is None:
+        ydl = yt_dlp.YoutubeDL(ydl_opts)
+        ydl.cookiejar  # Reads the cookie file now instead of on the first request.
+        _instances[key] = ydl
+    return ydl
+
+
+def warm_up(option_sets):
+    """A failure here is only reported; the instance is rebuilt on first use."""
+    for ydl_opts in option_sets:
+        try:
+            _instance(ydl_opts)
+        except Exception as e:
+            print(f"Extraction worker warm-up failed: {e}", file=sys.stderr)
+
+
+def extract(query: str, ydl_opts: dict):
+    """Returns (info, seconds spent extracting). The info dict is sanitized so it serializes."""
+    started = time.perf_counter()
+    ydl = _instance(ydl_opts)
+    info = ydl.extract_info(query, download=False)
+    return ydl.sanitize_info(info), time.perf_counter() - started
+
+
+def main():
+    replies = sys.stdout
+    # Anything yt-dlp prints must not end up between the replies.
+    sys.stdout = sys.stderr
+    warm_up(json.loads(sys.argv[1]) if len(sys.argv) > 1 else [])
+    for line in sys.stdin:
+        request = json.loads(line)
+        try:
+            info, seconds = extract(request['query'], request['opts'])
+            reply = json.dumps({'info': info, 'seconds': seconds})
+        except Exception as e:
+            reply = json.dumps({'error': str(e)})
+        replies.write(reply + "\n")
+        replies.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Offline stand-in for the Gemini API, selected with AI_BACKEND=fake.
+
+FakeAIClient covers the part of google.generativeai that the bot uses:
+client.get_model(name, system_instruction) returns a model whose
+generate_content_async() and start_chat(history).send_message_async() act like the
+real ones, streaming included. Nothing leaves the machine and no quota is spent.
+Latency is log-normal around FAKE_AI_LATENCY_MEDIAN_MS (pro models run
+FAKE_AI_PRO_SLOWDOWN times slower), 503s and 429s are injected at configurable
+rates, and every response carries usage_metadata token counts.
+"""
+import asyncio
+import math
+import os
+import random
+from types import SimpleNamespace
+
+import google.ai.generativelanguage as glm
+from google.api_core import exceptions as google_exceptions
+
+FAKE_AI_LATENCY_MEDIAN_MS = float(os.getenv("FAKE_AI_LATENCY_MEDIAN_MS", 700))
+FAKE_AI_LATENCY_SIGMA = float(os.getenv("FAKE_AI_LATENCY_SIGMA", 0.5))
+FAKE_AI_PRO_SLOWDOWN = float(os.getenv("FAKE_AI_PRO_SLOWDOWN", 2.5))
+FAKE_AI_ERROR_RATE = float(os.getenv("FAKE_AI_ERROR_RATE", 0))
+FAKE_AI_RATE_LIMIT_RATE = float(os.getenv("FAKE_AI_RATE_LIMIT_RATE", 0))
+FAKE_AI_REPLY_WORDS = int(os.getenv("FAKE_AI_REPLY_WORDS", 120))
+FAKE_AI_CHUNK_WORDS = int(os.getenv("FAKE_AI_CHUNK_WORDS", 15))
+FAKE_AI_CHUNK_DELAY_MS = float(os.getenv("FAKE_AI_CHUNK_DELAY_MS", 60))
+FAKE_AI_SEED = os.getenv("FAKE_AI_SEED")
+
+FAKE_AI_STATS = {'calls': 0, 'streamed': 0, 'errors': 0, 'rate_limited': 0, 'prompt_tokens': 0, 'reply_tokens': 0}
+
+WORDS = (
+    "aura thinks the answer depends on context but here is a clear and friendly take on it with "
+    "a few practical steps an example or two and a short summary at the end so nothing gets lost"
+).split()
+
+_rng = random.Random(FAKE_AI_SEED)
+
+
+def estimate_tokens(content) -> int:
+    """Same estimate as the bot's: about 4 characters per token, 258 per image."""
+    return sum(len(part.text) // 4 + (258 if part.inline_data.data else 0) for part in content.parts)
+
+
+def to_content(role: str, parts) -> glm.Content:
+    """Turn what callers pass to the SDK (text, blob dicts, Parts) into a Content."""
+    if isinstance(parts, glm.Content):
+        return parts
+    if isinstance(parts, (str, dict)):
+        parts = [parts]
+    converted = []
+    for part in parts:
+        if isinstance(part, str):
+            converted.append(glm.Part(text=part))
+        elif isinstance(part, dict):
+            converted.append(glm.Part(inline_data=glm.Blob(**part)))
+        else:
+            converted.append(part)
+    return glm.Content(role=role, parts=converted)
+
+
+class FakeResponse:
+    """A finished or streaming reply. Iterating it yields chunks with a .text attribute."""
+
+    def __init__(self, text: str, usage, on_complete=None):
+        words = text.split(" ")
+        self._chunks = [" ".join(words[i:i + FAKE_AI_CHUNK_WORDS]) + " " for i in range(0, len(words), FAKE_AI_CHUNK_WORDS)]
+        self._chunks[-1] = self._chunks[-1].rstrip()
+        self._text = text
+        self._on_complete = on_complete
+        self.usage_metadata = usage
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for i, piece in enumerate(self._chunks):
+            if i:
+                await asyncio.sleep(FAKE_AI_CHUNK_DELAY_MS / 1000)
+            yield SimpleNamespace(text=piece)
+        await self.resolve()
+
+    async def resolve(self):
+        if self._on_complete is not None:
+            self._on_complete(self._text)
+            self._on_complete = None
+
+
+class FakeModel:
+    def __init__(self, model_name: str, system_instruction: str = None):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self, history)
+
+    async def generate_content_async(self, contents, generation_config=None, stream=False):
+        return await self._respond([to_content('user', contents)], stream)
+
+    async def _respond(self, contents, stream: bool, on_complete=None) -> FakeResponse:
+        FAKE_AI_STATS['calls'] += 1
+        reply_words = max(1, int(_rng.expovariate(1 / FAKE_AI_REPLY_WORDS)))
+        chunks = math.ceil(reply_words / FAKE_AI_CHUNK_WORDS)
+        latency = _rng.lognormvariate(math.log(FAKE_AI_LATENCY_MEDIAN_MS / 1000), FAKE_AI_LATENCY_SIGMA)
+        if 'pro' in self.model_name:
+            latency *= FAKE_AI_PRO_SLOWDOWN
+        # A stream hands back its first chunk after `latency`; a plain call also waits for the rest.
+        await asyncio.sleep(latency if stream else latency + (chunks - 1) * FAKE_AI_CHUNK_DELAY_MS / 1000)
+
+        roll = _rng.random()
+        if roll < FAKE_AI_ERROR_RATE:
+            FAKE_AI_STATS['errors'] += 1
+            raise google_exceptions.ServiceUnavailable("fake backend: injected 503")
+        if roll < FAKE_AI_ERROR_RATE + FAKE_AI_RATE_LIMIT_RATE:
+            FAKE_AI_STATS['rate_limited'] += 1
+            raise google_exceptions.ResourceExhausted("fake backend: injected 429, quota exhausted")
+
+        text = " ".join(_rng.choice(WORDS) for _ in range(reply_words))
+        usage = SimpleNamespace(
+            prompt_token_count=sum(estimate_tokens(c) for c in contents),
+            candidates_token_count=len(text) // 4,
+        )
+        usage.total_token_count = usage.prompt_token_count + usage.candidates_token_count
+        FAKE_AI_STATS['prompt_tokens'] += usage.prompt_token_count
+        FAKE_AI_STATS['reply_tokens'] += usage.candidates_token_count
+        response = FakeResponse(text, usage, on_complete)
+        if stream:
+            FAKE_AI_STATS['streamed'] += 1
+        else:
+            await response.resolve()
+        return response
+
+
+class FakeChatSession:
+    def __init__(self, model: FakeModel, history=None):
+        self.model = model
+        self.history = list(history or [])
+
+    async def send_message_async(self, content, generation_config=None, stream=False):
+        message = to_content('user', content)
+
+        def complete(text):
+            self.history.extend([message, glm.Content(role='model', parts=[glm.Part(text=text)])])
+
+        return await self.model._respond(self.history + [message], stream, on_complete=complete)
+
+
+class FakeAIClient:
+    """Drop-in for GeminiClient: one per (fake) API key."""
+
+    def __init__(self, api_key: str, index: int):
+        self.api_key = api_key
+        self.name = f"key_{index}"
+        self._models = {}
+
+    def get_model(self, model_name: str, system_instruction: str):
+        cache_key = (model_name, system_instruction)
+        if cache_key not in self._models:
+            self._models[cache_key] = FakeModel(model_name, system_instruction)
+        return self._models[cache_key]
+
+    async def embed(self, model_name: str, texts):
+        # Deterministic per text, but carries no meaning; use MEMORY_EMBEDDER=hashing for real recall.
+        return [[random.Random(text).gauss(0, 1) for _ in range(768)] for text in texts]
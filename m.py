@@ -4,12 +4,16 @@ from discord.ext import commands
 from discord import app_commands
 from dotenv import load_dotenv
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
+from google.api_core import exceptions as google_exceptions
 import asyncio
 from PIL import Image
 import io
 import base64
 from typing import List, Optional
-import itertools
+import time
+from collections import deque, OrderedDict
+import contextlib
 
 load_dotenv()
 DISCORD_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
@@ -29,10 +33,120 @@ if not api_keys:
     exit()
 
 print(f"Loaded {len(api_keys)} API keys for rotation.")
-key_cycler = itertools.cycle(api_keys)
 
-def get_next_api_key():
-    return next(key_cycler)
+# --- API KEY SCHEDULER ---
+# Routes each request to the least-loaded healthy key. A key that hits a 429/quota
+# error sits out a cooldown instead of getting every Nth request like a plain cycle.
+# A key failing fast with other errors never has anything in flight, so it would look
+# the least loaded; any key whose recent error rate is above KEY_MAX_ERROR_RATE is
+# only picked when every other key is failing too.
+KEY_COOLDOWN_SECONDS = float(os.getenv("GEMINI_KEY_COOLDOWN_SECONDS", 60))
+KEY_MAX_ERROR_RATE = float(os.getenv("GEMINI_KEY_MAX_ERROR_RATE", 0.5))
+KEY_ERROR_WINDOW = 20
+KEY_MIN_ERROR_SAMPLES = 5
+
+def is_rate_limit_error(error: Exception) -> bool:
+    if isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)):
+        return True
+    message = str(error).lower()
+    return "429" in message or "quota" in message or "rate limit" in message
+
+class KeyScheduler:
+    def __init__(self, keys: List[str]):
+        self.stats = {
+            key: {'name': f"key_{n}", 'in_flight': 0, 'requests': 0, 'errors': 0, 'rate_limited': 0,
+                  'cooldown_until': 0.0, 'recent': deque(maxlen=KEY_ERROR_WINDOW)}
+            for n, key in enumerate(keys, start=1)
+        }
+
+    def error_rate(self, key: str) -> float:
+        recent = self.stats[key]['recent']
+        return recent.count(False) / len(recent) if recent else 0.0
+
+    def failing(self, key: str) -> bool:
+        return len(self.stats[key]['recent']) >= KEY_MIN_ERROR_SAMPLES and self.error_rate(key) > KEY_MAX_ERROR_RATE
+
+    def acquire(self) -> str:
+        now = time.monotonic()
+        healthy = [key for key, s in self.stats.items() if s['cooldown_until'] <= now]
+        if healthy:
+            key = min(healthy, key=lambda k: (self.failing(k), self.stats[k]['in_flight'], self.error_rate(k), self.stats[k]['requests']))
+        else:
+            # Every key is cooling down, so use whichever recovers first.
+            key = min(self.stats, key=lambda k: self.stats[k]['cooldown_until'])
+        self.stats[key]['in_flight'] += 1
+        self.stats[key]['requests'] += 1
+        return key
+
+    def release(self, key: str, error: Optional[Exception] = None, record: bool = True):
+        s = self.stats[key]
+        s['in_flight'] -= 1
+        if not record:
+            return
+        s['recent'].append(error is None)
+        if error is not None:
+            s['errors'] += 1
+            if is_rate_limit_error(error):
+                s['rate_limited'] += 1
+                s['cooldown_until'] = time.monotonic() + KEY_COOLDOWN_SECONDS
+
+    def report(self) -> List[dict]:
+        now = time.monotonic()
+        return [{
+            'name': s['name'], 'in_flight': s['in_flight'], 'requests': s['requests'], 'errors': s['errors'],
+            'rate_limited': s['rate_limited'], 'error_rate': self.error_rate(key),
+            'cooldown_left': max(0.0, s['cooldown_until'] - now),
+        } for key, s in self.stats.items()]
+
+KEY_SCHEDULER = KeyScheduler(api_keys)
+
+# --- GEMINI CLIENT POOL ---
+# One long-lived client per API key. genai.configure() swaps a process-wide default,
+# so two requests in flight could end up sending on each other's key. Instead every
+# model is bound to its own key's transport and cached per (model, system instruction).
+class GeminiClient:
+    def __init__(self, api_key: str, index: int):
+        self.api_key = api_key
+        self.name = f"key_{index}"
+        self._async_client = None
+        self._models = {}
+
+    def get_model(self, model_name: str, system_instruction: str):
+        cache_key = (model_name, system_instruction)
+        model = self._models.get(cache_key)
+        if model is None:
+            model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+            # GenerativeModel only falls back to the global default client when this is unset.
+            model._async_client = self._get_async_client()
+            self._models[cache_key] = model
+        return model
+
+    def _get_async_client(self):
+        # Created lazily so the gRPC channel is opened inside the bot's event loop.
+        if self._async_client is None:
+            self._async_client = glm.GenerativeServiceAsyncClient(client_options={"api_key": self.api_key})
+        return self._async_client
+
+class GeminiClientPool:
+    def __init__(self, keys: List[str]):
+        self.clients = {key: GeminiClient(key, n) for n, key in enumerate(keys, start=1)}
+
+    @contextlib.asynccontextmanager
+    async def checkout(self):
+        key = KEY_SCHEDULER.acquire()
+        error, record = None, True
+        try:
+            yield self.clients[key]
+        except asyncio.CancelledError:
+            record = False
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            KEY_SCHEDULER.release(key, error, record)
+
+GEMINI_POOL = GeminiClientPool(api_keys)
 
 CHAT_CHANNEL_NAME = "chat-with-aura"
 
@@ -42,8 +156,83 @@ intents.members = True
 intents.guilds = True
 bot = commands.Bot(command_prefix="!", intents=intents)
 
+# --- CONVERSATION HISTORY STORE ---
+# Per-user chat history with hard limits: at most MAX_CHAT_SESSIONS users (least
+# recently used evicted first), a turn and byte budget per user (oldest turns trimmed
+# first, uploaded images included), and idle sessions dropped after SESSION_IDLE_TTL.
+MAX_CHAT_SESSIONS = int(os.getenv("MAX_CHAT_SESSIONS", 500))
+MAX_SESSION_TURNS = int(os.getenv("MAX_SESSION_TURNS", 30))
+MAX_SESSION_BYTES = int(os.getenv("MAX_SESSION_BYTES", 4 * 1024 * 1024))
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL_SECONDS", 3600))
+
+def estimate_content_bytes(content) -> int:
+    return sum(len(part.text.encode('utf-8')) + len(part.inline_data.data) for part in content.parts)
+
+class SessionStore:
+    def __init__(self, max_sessions: int, max_turns: int, max_bytes: int, idle_ttl: float):
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self._sessions = OrderedDict()
+        self.total_bytes = 0
+        self.counters = {'evicted': 0, 'expired': 0, 'trimmed_turns': 0}
+
+    def get(self, user_id):
+        entry = self._sessions.get(user_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry['last_used'] > self.idle_ttl:
+            self.pop(user_id)
+            self.counters['expired'] += 1
+            return None
+        self._sessions.move_to_end(user_id)
+        return entry
+
+    def put(self, user_id, history, **fields):
+        history = list(history)
+        sizes = [estimate_content_bytes(content) for content in history]
+        # Drop whole user/model turns from the front so the history still starts with the user.
+        while history and (len(history) > self.max_turns * 2 or sum(sizes) > self.max_bytes):
+            del history[:2], sizes[:2]
+            self.counters['trimmed_turns'] += 1
+        self.pop(user_id)
+        entry = {'history': history, 'bytes': sum(sizes), 'last_used': time.monotonic(), **fields}
+        self._sessions[user_id] = entry
+        self.total_bytes += entry['bytes']
+        self._evict()
+        return entry
+
+    def pop(self, user_id):
+        entry = self._sessions.pop(user_id, None)
+        if entry is not None:
+            self.total_bytes -= entry['bytes']
+        return entry
+
+    def _evict(self):
+        now = time.monotonic()
+        # Entries are kept in least-recently-used order, so idle ones sit at the front.
+        while self._sessions:
+            user_id, entry = next(iter(self._sessions.items()))
+            if now - entry['last_used'] > self.idle_ttl:
+                self.pop(user_id)
+                self.counters['expired'] += 1
+            elif len(self._sessions) > self.max_sessions:
+                self.pop(user_id)
+                self.counters['evicted'] += 1
+            else:
+                break
+
+    def footprint(self) -> dict:
+        return {
+            'sessions': len(self._sessions),
+            'turns': sum(len(entry['history']) // 2 for entry in self._sessions.values()),
+            'bytes': self.total_bytes,
+            **self.counters,
+        }
+
 server_modes = {}
-conversation_history = {}
+conversation_history = SessionStore(MAX_CHAT_SESSIONS, MAX_SESSION_TURNS, MAX_SESSION_BYTES, SESSION_IDLE_TTL)
 DEFAULT_MODE = "study_search"
 
 async def send_long_response(interaction_or_message, text, embed=None):
@@ -88,8 +277,6 @@ async def send_long_response(interaction_or_message, text, embed=None):
 
 async def ask_aura_ai(prompt: str, user_id: int, guild_id: int, images: List[Image.Image] = None):
     try:
-        genai.configure(api_key=get_next_api_key())
-
         current_mode = server_modes.get(guild_id, DEFAULT_MODE)
         
         system_instruction = ""
@@ -108,24 +295,24 @@ async def ask_aura_ai(prompt: str, user_id: int, guild_id: int, images: List[Ima
         generation_config = genai.types.GenerationConfig(temperature=temperature)
 
         model_name = 'gemini-1.5-pro-latest' if current_mode == 'study_search' else 'gemini-1.5-flash'
-        model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
         
+        # Only the history is kept per user; the session itself is rebuilt on whichever
+        # client we check out, so a conversation never stays pinned to one key.
         user_convo_data = conversation_history.get(user_id)
-        
-        if user_convo_data and user_convo_data['model'] == model_name:
-            chat_session = user_convo_data['session']
-        else:
-            chat_session = model.start_chat(history=[])
-            conversation_history[user_id] = {'session': chat_session, 'model': model_name}
+        history = user_convo_data['history'] if user_convo_data and user_convo_data['model'] == model_name else []
 
         message_parts = [prompt]
         if images:
             message_parts.extend(images)
 
-        response = await chat_session.send_message_async(
-            content=message_parts,
-            generation_config=generation_config
-        )
+        async with GEMINI_POOL.checkout() as client:
+            model = client.get_model(model_name, system_instruction)
+            chat_session = model.start_chat(history=history)
+            response = await chat_session.send_message_async(
+                content=message_parts,
+                generation_config=generation_config
+            )
+        conversation_history.put(user_id, chat_session.history, model=model_name)
         return response.text
 
     except Exception as e:
@@ -190,16 +377,14 @@ async def mode_error(interaction: discord.Interaction, error: app_commands.AppCo
 async def imagine(interaction: discord.Interaction, prompt: str):
     await interaction.response.defer(thinking=True)
     try:
-        genai.configure(api_key=get_next_api_key())
-        
-        img_model = genai.GenerativeModel('gemini-2.0-flash-preview-image-generation')
-        
         image_generation_config = {"response_modalities": ['IMAGE']}
         
-        response = await img_model.generate_content_async(
-            prompt,
-            generation_config=image_generation_config
-        )
+        async with GEMINI_POOL.checkout() as client:
+            img_model = client.get_model('gemini-2.0-flash-preview-image-generation', None)
+            response = await img_model.generate_content_async(
+                prompt,
+                generation_config=image_generation_config
+            )
         
         img_part = next((part for part in response.parts if part.inline_data), None)
         if img_part:
@@ -10,6 +10,8 @@ import google.generativeai as genai
 import asyncio
 from PIL import Image
 import io
+import time
+from collections import OrderedDict
 
 # --- SETUP ---
 # Load environment variables from a .env file
@@ -33,9 +35,82 @@ intents = discord.Intents.default()
 intents.message_content = True
 bot = commands.Bot(command_prefix="!", intents=intents)
 
+# Limits for the stored chat history (see HistoryStore below)
+MAX_CHAT_SESSIONS = int(os.getenv("MAX_CHAT_SESSIONS", 500))
+MAX_SESSION_TURNS = int(os.getenv("MAX_SESSION_TURNS", 30))
+MAX_SESSION_BYTES = int(os.getenv("MAX_SESSION_BYTES", 4 * 1024 * 1024))
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL_SECONDS", 3600))
+
 # --- STATE MANAGEMENT ---
-# Dictionary to store conversation history for the chat feature
-CONVERSATION_HISTORY = {}
+class HistoryStore:
+    """
+    Bounded store for per-user chat history.
+    Keeps at most max_sessions users (least recently used are evicted first), trims the
+    oldest turns of a user once they exceed max_turns or max_bytes, and forgets users
+    who have been idle for longer than idle_ttl seconds.
+    """
+    def __init__(self, max_sessions, max_turns, max_bytes, idle_ttl):
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self._sessions = OrderedDict()
+        self.total_bytes = 0
+        self.counters = {'evicted': 0, 'expired': 0, 'trimmed_turns': 0}
+
+    @staticmethod
+    def content_bytes(content):
+        """Approximate size of one history entry, counting text and inline image data."""
+        return sum(len(part.text.encode('utf-8')) + len(part.inline_data.data) for part in content.parts)
+
+    def get(self, user_id):
+        """Returns the user's history, or an empty list if there is none or it expired."""
+        entry = self._sessions.get(user_id)
+        if entry is None:
+            return []
+        if time.monotonic() - entry['last_used'] > self.idle_ttl:
+            self._drop(user_id)
+            self.counters['expired'] += 1
+            return []
+        self._sessions.move_to_end(user_id)
+        return entry['history']
+
+    def put(self, user_id, history):
+        """Stores the user's history, trimming it to the turn and byte budget."""
+        history = list(history)
+        sizes = [self.content_bytes(content) for content in history]
+        while history and (len(history) > self.max_turns * 2 or sum(sizes) > self.max_bytes):
+            del history[:2], sizes[:2]
+            self.counters['trimmed_turns'] += 1
+        self._drop(user_id)
+        self._sessions[user_id] = {'history': history, 'bytes': sum(sizes), 'last_used': time.monotonic()}
+        self.total_bytes += sum(sizes)
+        self._evict()
+
+    def _drop(self, user_id):
+        entry = self._sessions.pop(user_id, None)
+        if entry is not None:
+            self.total_bytes -= entry['bytes']
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._sessions:
+            user_id, entry = next(iter(self._sessions.items()))
+            if now - entry['last_used'] > self.idle_ttl:
+                self._drop(user_id)
+                self.counters['expired'] += 1
+            elif len(self._sessions) > self.max_sessions:
+                self._drop(user_id)
+                self.counters['evicted'] += 1
+            else:
+                break
+
+    def footprint(self):
+        """Current size of the store plus eviction counters."""
+        return {'sessions': len(self._sessions), 'bytes': self.total_bytes, **self.counters}
+
+# Conversation history for the chat feature
+CONVERSATION_HISTORY = HistoryStore(MAX_CHAT_SESSIONS, MAX_SESSION_TURNS, MAX_SESSION_BYTES, SESSION_IDLE_TTL)
 
 # --- HELPER FUNCTIONS ---
 
@@ -68,7 +143,7 @@ async def ask_aura_ai(prompt: str, image: Image.Image = None, user_id: int = Non
     print(f"Sending prompt to AI for user {user_id}: '{prompt[:50]}...'")
     try:
         model = genai.GenerativeModel('gemini-1.5-flash')
-        history = CONVERSATION_HISTORY.get(user_id, [])
+        history = CONVERSATION_HISTORY.get(user_id) if user_id is not None else []
         chat = model.start_chat(history=history)
 
         message_parts = [prompt]
@@ -80,7 +155,8 @@ async def ask_aura_ai(prompt: str, image: Image.Image = None, user_id: int = Non
         
         response = await asyncio.wait_for(loop.run_in_executor(None, send_func), timeout=60.0)
         
-        CONVERSATION_HISTORY[user_id] = chat.history
+        if user_id is not None:
+            CONVERSATION_HISTORY.put(user_id, chat.history)
         print("Received response from AI.")
         return response.text
 
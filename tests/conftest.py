@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def tt(tmp_path_factory):
+    # tt.py reads its settings and opens its log, caches and memory index at import
+    # time, so import it once with the offline AI backend from a scratch directory.
+    os.environ['AI_BACKEND'] = 'fake'
+    os.environ['FAKE_AI_LATENCY_MEDIAN_MS'] = '1'
+    os.environ['FAKE_AI_CHUNK_DELAY_MS'] = '0'
+    previous_cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("tt"))
+    sys.path.insert(0, REPO_ROOT)
+    import tt as module
+    yield module
+    os.chdir(previous_cwd)
@@ -0,0 +1,125 @@
+import asyncio
+import json
+
+
+def test_response_cache_flushes_only_when_dirty(tt, tmp_path):
+    path = tmp_path / "responses.json"
+    cache = tt.ResponseCache(10, 3600, str(path))
+
+    asyncio.run(cache.flush())
+    assert not path.exists()
+
+    cache.put("key", "answer")
+    asyncio.run(cache.flush())
+    assert json.loads(path.read_text())["key"]["text"] == "answer"
+
+    path.unlink()
+    asyncio.run(cache.flush())
+    assert not path.exists()
+
+    cache.put("other", "reply")
+    cache.save()
+    assert tt.ResponseCache(10, 3600, str(path)).get("other") == "reply"
+
+
+def test_single_flight_elects_one_new_leader_after_a_failure(tt, monkeypatch):
+    import fake_ai
+
+    calls = []
+    respond = fake_ai.FakeModel._respond
+
+    async def fail_first(self, contents, stream, on_complete=None):
+        calls.append(self.model_name)
+        await asyncio.sleep(0.05)
+        if len(calls) == 1:
+            raise RuntimeError("upstream failed")
+        return await respond(self, contents, stream, on_complete)
+
+    monkeypatch.setattr(fake_ai.FakeModel, "_respond", fail_first)
+    monkeypatch.setattr(tt, "with_retries", lambda attempt: attempt)
+
+    async def run():
+        return await asyncio.gather(*(tt.ask_aura_ai_stateless("single flight prompt", user_id=n, guild_id=1)
+                                      for n in range(5)))
+
+    replies = asyncio.run(run())
+    assert len(calls) == 2
+    assert replies[0].startswith("Sorry")
+    assert len(set(replies[1:])) == 1
+
+
+def test_history_compaction_keeps_session_recency(tt):
+    glm = tt.glm
+    store = tt.SessionStore(max_sessions=10, max_turns=30, max_bytes=1 << 20, idle_ttl=3600)
+    turn = lambda role, text: glm.Content(role=role, parts=[glm.Part(text=text)])
+    store.put(1, [turn('user', 'hi'), turn('model', 'hello')], model='flash')
+    store.put(2, [turn('user', 'yo'), turn('model', 'hey')])
+    last_used = store.peek(1)['last_used']
+
+    entry = store.replace_history(1, [turn('user', 'summary'), turn('model', 'ok')])
+
+    assert list(store._sessions) == [1, 2]
+    assert entry['last_used'] == last_used and entry['model'] == 'flash'
+    assert entry['history'][0].parts[0].text == 'summary'
+    assert store.total_bytes == sum(e['bytes'] for e in store._sessions.values())
+
+
+def test_trimming_keeps_the_compaction_summary(tt):
+    glm = tt.glm
+    store = tt.SessionStore(max_sessions=10, max_turns=3, max_bytes=1 << 20, idle_ttl=3600)
+    turn = lambda role, text: glm.Content(role=role, parts=[glm.Part(text=text)])
+    history = [turn('user', f"{tt.SUMMARY_HEADER}\nlikes jazz"), turn('model', 'ok')]
+    for n in range(4):
+        history += [turn('user', f"q{n}"), turn('model', f"a{n}")]
+
+    entry = store.put(1, history)
+
+    texts = [content.parts[0].text for content in entry['history']]
+    assert texts == [history[0].parts[0].text, 'ok', 'q2', 'a2', 'q3', 'a3']
+    assert store.counters['trimmed_turns'] == 2
+
+
+def test_memory_index_flushes_and_forgets_off_the_loop(tt, tmp_path):
+    index = tt.MemoryIndex(str(tmp_path), tt.HashingEmbedder())
+    meta_path = tmp_path / "7.json"
+
+    async def run():
+        await index.add(7, "User: my cat is named tom\nAura: nice")
+        assert not meta_path.exists()
+        await index.flush()
+        assert json.loads(meta_path.read_text())['snippets'] == ["User: my cat is named tom\nAura: nice"]
+        await index.add(7, "User: my dog is rex\nAura: good dog")
+        await index.forget(7)
+
+    asyncio.run(run())
+    assert not meta_path.exists()
+    assert not (tmp_path / "7.npy").exists()
+
+    other = tt.MemoryIndex(str(tmp_path), tt.HashingEmbedder())
+    asyncio.run(other.add(8, "User: hi\nAura: hello"))
+    other.save()
+    assert tt.MemoryIndex(str(tmp_path), tt.HashingEmbedder())._load(8)['snippets'] == ["User: hi\nAura: hello"]
+
+
+def test_image_analysis_is_shared_between_users(tt, monkeypatch):
+    import fake_ai
+
+    histories = []
+    start_chat = fake_ai.FakeModel.start_chat
+    monkeypatch.setattr(fake_ai.FakeModel, "start_chat", lambda self, history=None: histories.append(list(history or [])) or start_chat(self, history))
+    images = [{'mime_type': 'image/jpeg', 'data': b'same meme'}]
+    tt.conversation_history.put(21, [tt.glm.Content(role='user', parts=[tt.glm.Part(text='my secret')]),
+                                     tt.glm.Content(role='model', parts=[tt.glm.Part(text='noted')])])
+
+    async def run():
+        first = await tt.ask_aura_ai("what is this?", user_id=21, guild_id=1, images=images, cache_analysis=True)
+        calls = fake_ai.FAKE_AI_STATS['calls']
+        second = await tt.ask_aura_ai("what is this?", user_id=22, guild_id=1, images=images, cache_analysis=True)
+        return first, second, fake_ai.FAKE_AI_STATS['calls'] - calls
+
+    first, second, extra_calls = asyncio.run(run())
+    assert second == first and extra_calls == 0
+    assert histories == [[]]
+    for user_id in (21, 22):
+        assert tt.conversation_history.peek(user_id)['history'][-1].parts[0].text == first
+    assert tt.conversation_history.peek(21)['history'][0].parts[0].text == 'my secret'
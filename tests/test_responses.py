@@ -0,0 +1,109 @@
+import asyncio
+
+
+class FakeMessage:
+    def __init__(self, channel, content=None, embed=None):
+        self.id = len(channel.sent) + 1
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+
+    async def reply(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    async def edit(self, content=None, embed=None, **kwargs):
+        self.content = content if content is not None else self.content
+        self.embed = embed if embed is not None else self.embed
+
+
+class FakeChannel:
+    id = 1
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content=None, embed=None, **kwargs):
+        message = FakeMessage(self, content, embed)
+        self.sent.append(message)
+        return message
+
+
+async def stream_of(*pieces):
+    for piece in pieces:
+        yield piece
+
+
+def test_code_block_split_across_chunks(tt):
+    code = "```python\n" + "".join(f"    value_{n} = {n}\n" for n in range(200)) + "```"
+    text = "Here is the script:\n\n" + code + "\n\nThat's it."
+    chunks = list(tt.iter_response_chunks(text))
+
+    assert len(chunks) > 1
+    assert all(len(chunk) <= tt.MESSAGE_LIMIT for chunk in chunks)
+    assert chunks[0].endswith("\n```")
+    assert chunks[1].startswith("```python\n")
+    assert all(chunk.count("```") % 2 == 0 for chunk in chunks)
+
+    chunker = tt.ResponseChunker()
+    chunker.feed(text[:2500])
+    chunker.close()
+    assert chunker.tail() == ""
+
+
+def test_stream_split_inside_code_block_sends_no_empty_fence(tt):
+    code = "```python\n" + "".join(f"    value_{n} = {n}\n" for n in range(200))
+    channel = FakeChannel()
+    message = FakeMessage(channel)
+
+    text = asyncio.run(tt.stream_long_response(message, stream_of(code[:1500], code[1500:])))
+
+    assert text == code
+    contents = [sent.content for sent in channel.sent]
+    assert contents == list(tt.iter_response_chunks(code))
+    assert all(content.strip() != "```python" for content in contents)
+
+
+class BlockedChunk:
+    @property
+    def text(self):
+        raise ValueError("chunk carries only a finish reason")
+
+
+def test_blocked_stream_sends_apology(tt, monkeypatch):
+    import fake_ai
+
+    async def blocked(self):
+        yield BlockedChunk()
+        await self.resolve()
+
+    monkeypatch.setattr(fake_ai.FakeResponse, "_iterate", blocked)
+    apology = "Sorry, I encountered an error while thinking. Please try again."
+
+    key_errors = sum(s['errors'] for s in tt.KEY_SCHEDULER.stats.values())
+
+    for stream in (tt.ask_aura_ai_stream("hello", user_id=1, guild_id=1),
+                   tt.ask_aura_ai_stateless_stream("summarize this", user_id=1, guild_id=1)):
+        channel = FakeChannel()
+        text = asyncio.run(tt.stream_long_response(FakeMessage(channel), stream))
+        assert text == apology
+        assert [sent.content for sent in channel.sent] == [apology]
+
+    # A blocked reply is the model's answer, not a failing key.
+    assert sum(s['errors'] for s in tt.KEY_SCHEDULER.stats.values()) == key_errors
+
+
+def test_diagnostics_embed_stays_within_discord_limits(tt):
+    lines = [f"`key_{n}` ✅ | In flight: **0** | Requests: 12 | Errors: 0 (429s: 0) | Recent: 0%" for n in range(40)]
+    value = tt.field_lines(lines)
+    assert len(value) <= 1024 and value.splitlines()[-1].startswith("…and ")
+
+    embed = tt.discord.Embed(title="🩺 Aura Diagnostics")
+    for n in range(30):
+        embed.add_field(name=f"Field {n}", value="x" * 1500, inline=False)
+    pages = tt.paginate_embed(embed)
+
+    assert sum(len(page.fields) for page in pages) == 30
+    for page in pages:
+        assert len(page.fields) <= 25
+        assert all(len(field.value) <= 1024 for field in page.fields)
+        assert len(page.title) + sum(len(f.name) + len(f.value) for f in page.fields) <= 6000
@@ -4,23 +4,32 @@ from discord.ext import commands
 from discord import app_commands
 from dotenv import load_dotenv
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
+from google.api_core import exceptions as google_exceptions
 import asyncio
-from PIL import Image
+from PIL import Image, ImageOps
 import io
 import base64
 from typing import List, Optional
-import itertools
+import contextlib
 import random
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 import numpy as np
 import aiohttp
-import yt_dlp
-from collections import deque
+import sys
+from collections import deque, OrderedDict
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
+from spotipy.exceptions import SpotifyException
 import time
 import logging
+import hashlib
+import sqlite3
+from urllib.parse import urlparse, parse_qs
+import unicodedata
+import re
+import concurrent.futures
 
 # --- SETUP ---
 load_dotenv()
@@ -35,6 +44,11 @@ logging.basicConfig(level=logging.INFO,
                         logging.StreamHandler()
                     ])
 
+# "gemini" talks to the real API; "fake" uses the offline stand-in in fake_ai.py,
+# which needs no keys and spends no quota (see bench.py).
+AI_BACKEND = os.getenv("AI_BACKEND", "gemini").lower()
+FAKE_AI_KEYS = int(os.getenv("FAKE_AI_KEYS", 3))
+
 api_keys = []
 i = 1
 while True:
@@ -45,15 +59,267 @@ while True:
     else:
         break
 
-if not api_keys:
+if not api_keys and AI_BACKEND == "fake":
+    api_keys = [f"fake-key-{n}" for n in range(1, FAKE_AI_KEYS + 1)]
+elif not api_keys:
     print("Error: No GEMINI_API_KEY_{n} variables found in .env file.")
     exit()
 
 print(f"Loaded {len(api_keys)} API keys for rotation.")
-key_cycler = itertools.cycle(api_keys)
 
-def get_next_api_key():
-    return next(key_cycler)
+# --- RETRIES & CIRCUIT BREAKERS ---
+# Transient failures (5xx, timeouts, dropped connections, 429s) are retried up to
+# RETRY_MAX_ATTEMPTS times, with exponential backoff and full jitter between tries.
+# Each key and each model has a breaker. After BREAKER_FAILURE_THRESHOLD transient
+# failures in a row it opens, and requests fail fast for BREAKER_RESET_SECONDS. After
+# that it goes half-open and lets a single probe through. A successful probe closes
+# the breaker; a failed one opens it again. A 429 only counts against its key's
+# breaker: the quota belongs to that key, and other keys can still serve the model.
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", 3))
+RETRY_BASE_DELAY_SECONDS = float(os.getenv("RETRY_BASE_DELAY_SECONDS", 0.5))
+RETRY_MAX_DELAY_SECONDS = float(os.getenv("RETRY_MAX_DELAY_SECONDS", 8))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", 5))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", 30))
+AI_UNAVAILABLE_MESSAGE = "My connection to the AI service is down right now. Please try again in a minute. 🔌"
+RETRY_STATS = {'retries': 0, 'gave_up': 0}
+
+TRANSIENT_ERRORS = (
+    google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError,
+    google_exceptions.BadGateway, google_exceptions.GatewayTimeout, google_exceptions.DeadlineExceeded,
+    asyncio.TimeoutError, ConnectionError,
+)
+
+def is_transient_error(error: Exception) -> bool:
+    return isinstance(error, TRANSIENT_ERRORS) or is_rate_limit_error(error)
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, name: str):
+        self.name = name
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.counters = {'opened': 0, 'rejected': 0}
+
+    def is_open(self) -> bool:
+        return self.state == 'open' and time.monotonic() - self.opened_at < BREAKER_RESET_SECONDS
+
+    def allow(self) -> bool:
+        if self.state == 'closed':
+            return True
+        if self.state == 'open' and not self.is_open():
+            self.state = 'half_open'
+        if self.state == 'half_open' and not self.probing:
+            self.probing = True
+            return True
+        self.counters['rejected'] += 1
+        return False
+
+    def record(self, error: Optional[Exception]):
+        self.probing = False
+        if error is None or not is_transient_error(error):
+            # A non-transient error (bad request, safety block) still means the service answered.
+            self.state = 'closed'
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= BREAKER_FAILURE_THRESHOLD:
+            if self.state != 'open':
+                self.counters['opened'] += 1
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+
+    def abandon(self):
+        # The call was cancelled before it could tell us anything.
+        self.probing = False
+
+    def report(self) -> dict:
+        state = 'half_open' if self.state == 'open' and not self.is_open() else self.state
+        return {'name': self.name, 'state': state, 'failures': self.failures, **self.counters}
+
+MODEL_BREAKERS = {}
+
+def get_model_breaker(model_name: str) -> CircuitBreaker:
+    if model_name not in MODEL_BREAKERS:
+        MODEL_BREAKERS[model_name] = CircuitBreaker(model_name)
+    return MODEL_BREAKERS[model_name]
+
+def backoff_delay(n: int) -> float:
+    # Full jitter: anywhere between zero and the capped exponential delay for retry n.
+    return random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** n))
+
+def with_retries(attempt):
+    # Wraps attempt(model_name) with the model's breaker and the retry policy.
+    async def run(model_name: str):
+        breaker = get_model_breaker(model_name)
+        for n in range(RETRY_MAX_ATTEMPTS):
+            if not breaker.allow():
+                raise CircuitOpenError(f"{model_name} is unavailable")
+            try:
+                result = await attempt(model_name)
+            except asyncio.CancelledError:
+                breaker.abandon()
+                raise
+            except CircuitOpenError:
+                # Every key is open; leave the model's own breaker alone.
+                breaker.abandon()
+                raise
+            except Exception as e:
+                if is_rate_limit_error(e):
+                    # The key's cooldown and breaker handle this; the model itself is fine.
+                    breaker.abandon()
+                else:
+                    breaker.record(e)
+                if not is_transient_error(e) or n == RETRY_MAX_ATTEMPTS - 1:
+                    if is_transient_error(e):
+                        RETRY_STATS['gave_up'] += 1
+                    raise
+                RETRY_STATS['retries'] += 1
+                await asyncio.sleep(backoff_delay(n))
+            else:
+                breaker.record(None)
+                return result
+    return run
+
+# --- API KEY SCHEDULER ---
+# Routes each request to the least-loaded healthy key. A key that hits a 429/quota
+# error sits out a cooldown instead of getting every Nth request like a plain cycle.
+# A key failing fast with other errors never has anything in flight, so it would look
+# the least loaded; any key whose recent error rate is above KEY_MAX_ERROR_RATE is
+# only picked when every other key is failing too.
+KEY_COOLDOWN_SECONDS = float(os.getenv("GEMINI_KEY_COOLDOWN_SECONDS", 60))
+KEY_MAX_ERROR_RATE = float(os.getenv("GEMINI_KEY_MAX_ERROR_RATE", 0.5))
+KEY_ERROR_WINDOW = 20
+KEY_MIN_ERROR_SAMPLES = 5
+
+def is_rate_limit_error(error: Exception) -> bool:
+    if isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)):
+        return True
+    message = str(error).lower()
+    return "429" in message or "quota" in message or "rate limit" in message
+
+class KeyScheduler:
+    def __init__(self, keys: List[str]):
+        self.stats = {
+            key: {'name': f"key_{n}", 'in_flight': 0, 'requests': 0, 'errors': 0, 'rate_limited': 0,
+                  'cooldown_until': 0.0, 'recent': deque(maxlen=KEY_ERROR_WINDOW), 'breaker': CircuitBreaker(f"key_{n}")}
+            for n, key in enumerate(keys, start=1)
+        }
+
+    def error_rate(self, key: str) -> float:
+        recent = self.stats[key]['recent']
+        return recent.count(False) / len(recent) if recent else 0.0
+
+    def failing(self, key: str) -> bool:
+        return len(self.stats[key]['recent']) >= KEY_MIN_ERROR_SAMPLES and self.error_rate(key) > KEY_MAX_ERROR_RATE
+
+    def acquire(self) -> str:
+        now = time.monotonic()
+        candidates = [key for key, s in self.stats.items() if not s['breaker'].is_open()]
+        if not candidates:
+            raise CircuitOpenError("every API key's circuit breaker is open")
+        healthy = [key for key in candidates if self.stats[key]['cooldown_until'] <= now]
+        if healthy:
+            ranked = sorted(healthy, key=lambda k: (self.failing(k), self.stats[k]['in_flight'], self.error_rate(k), self.stats[k]['requests']))
+        else:
+            # Every key is cooling down, so use whichever recovers first.
+            ranked = sorted(candidates, key=lambda k: self.stats[k]['cooldown_until'])
+        key = next((k for k in ranked if self.stats[k]['breaker'].allow()), None)
+        if key is None:
+            raise CircuitOpenError("every API key's circuit breaker is open or probing")
+        self.stats[key]['in_flight'] += 1
+        self.stats[key]['requests'] += 1
+        return key
+
+    def release(self, key: str, error: Optional[Exception] = None, record: bool = True):
+        s = self.stats[key]
+        s['in_flight'] -= 1
+        if not record:
+            s['breaker'].abandon()
+            return
+        s['breaker'].record(error)
+        s['recent'].append(error is None)
+        if error is not None:
+            s['errors'] += 1
+            if is_rate_limit_error(error):
+                s['rate_limited'] += 1
+                s['cooldown_until'] = time.monotonic() + KEY_COOLDOWN_SECONDS
+
+    def report(self) -> List[dict]:
+        now = time.monotonic()
+        return [{
+            'name': s['name'], 'in_flight': s['in_flight'], 'requests': s['requests'], 'errors': s['errors'],
+            'rate_limited': s['rate_limited'], 'error_rate': self.error_rate(key),
+            'cooldown_left': max(0.0, s['cooldown_until'] - now),
+        } for key, s in self.stats.items()]
+
+KEY_SCHEDULER = KeyScheduler(api_keys)
+
+# --- GEMINI CLIENT POOL ---
+# One long-lived client per API key. genai.configure() swaps a process-wide default,
+# so two requests in flight could end up sending on each other's key. Instead every
+# model is bound to its own key's transport and cached per (model, system instruction).
+class GeminiClient:
+    def __init__(self, api_key: str, index: int):
+        self.api_key = api_key
+        self.name = f"key_{index}"
+        self._async_client = None
+        self._models = {}
+
+    def get_model(self, model_name: str, system_instruction: str):
+        cache_key = (model_name, system_instruction)
+        model = self._models.get(cache_key)
+        if model is None:
+            model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+            # GenerativeModel only falls back to the global default client when this is unset.
+            model._async_client = self._get_async_client()
+            self._models[cache_key] = model
+        return model
+
+    async def embed(self, model_name: str, texts: List[str]) -> List[List[float]]:
+        model = f"models/{model_name}"
+        response = await self._get_async_client().batch_embed_contents(request=glm.BatchEmbedContentsRequest(
+            model=model,
+            requests=[glm.EmbedContentRequest(model=model, content=glm.Content(parts=[glm.Part(text=text)])) for text in texts]
+        ))
+        return [list(embedding.values) for embedding in response.embeddings]
+
+    def _get_async_client(self):
+        # Created lazily so the gRPC channel is opened inside the bot's event loop.
+        if self._async_client is None:
+            self._async_client = glm.GenerativeServiceAsyncClient(client_options={"api_key": self.api_key})
+        return self._async_client
+
+class GeminiClientPool:
+    # client_factory(key, index) builds the per-key backend. Anything with
+    # get_model(model_name, system_instruction) returning a model that has
+    # generate_content_async() and start_chat(), plus embed(model_name, texts), will do.
+    def __init__(self, keys: List[str], client_factory=GeminiClient):
+        self.clients = {key: client_factory(key, n) for n, key in enumerate(keys, start=1)}
+
+    @contextlib.asynccontextmanager
+    async def checkout(self):
+        key = KEY_SCHEDULER.acquire()
+        error, record = None, True
+        try:
+            yield self.clients[key]
+        except asyncio.CancelledError:
+            record = False
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            KEY_SCHEDULER.release(key, error, record)
+
+if AI_BACKEND == "fake":
+    from fake_ai import FakeAIClient
+    GEMINI_POOL = GeminiClientPool(api_keys, FakeAIClient)
+else:
+    GEMINI_POOL = GeminiClientPool(api_keys)
 
 # --- Load Privileged User IDs ---
 OWNER_IDS_STR = os.getenv("OWNER_IDS", "")
@@ -66,6 +332,9 @@ CHAT_CHANNEL_NAME = "chat-with-aura"
 
 # --- Global State & Theme Colors ---
 SONG_QUEUES = {}
+PLAYBACK_STARTING = set()
+IDLE_DISCONNECT_TASKS = {}
+IDLE_DISCONNECT_SECONDS = 180
 NOW_PLAYING_MESSAGES = {}
 GUILD_VOLUMES = {}
 THEME_COLOR_BLUE = discord.Color.from_rgb(52, 152, 219) 
@@ -78,35 +347,498 @@ else:
     spotify = None
     print("Spotify credentials not found. Spotify integration will be disabled.")
 
+# --- EXTRACTION POOL ---
+# yt-dlp runs in EXTRACT_WORKERS worker processes (extract_worker.py), so its parsing
+# can't hold this process's GIL and delay gateway heartbeats. A worker is a separate
+# script, so it never imports the bot. It keeps warm YoutubeDL instances for the
+# search and stream option sets, with the cookie file already loaded. Calls are handed
+# one at a time to idle workers; workers start on demand up to EXTRACT_WORKERS. A call
+# that isn't answered within EXTRACT_TIMEOUT, or that is cancelled, fails. If it was
+# already running, its worker is killed and replaced, so a stuck extraction never keeps
+# a worker busy.
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", 2))
+EXTRACT_TIMEOUT = float(os.getenv("EXTRACT_TIMEOUT_SECONDS", 30))
+EXTRACT_SOCKET_TIMEOUT = float(os.getenv("EXTRACT_SOCKET_TIMEOUT_SECONDS", 15))
+EXTRACT_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "extract_worker.py")
+EXTRACT_MAX_REPLY_BYTES = 32 * 1024 * 1024
+SEARCH_OPTS = {"format": "bestaudio", "noplaylist": True, "quiet": True, "extract_flat": True, "cookiefile": "cookies.txt",
+               "socket_timeout": EXTRACT_SOCKET_TIMEOUT}
+STREAM_OPTS = {"format": "bestaudio", "quiet": True, "cookiefile": "cookies.txt", "socket_timeout": EXTRACT_SOCKET_TIMEOUT}
+
+class ExtractionError(Exception):
+    pass
+
+class ExtractionTimeout(ExtractionError):
+    pass
+
+class ExtractionPool:
+    def __init__(self, workers: int, timeout: float, warm_options: list):
+        self.workers = workers
+        self.timeout = timeout
+        self.warm_options = warm_options
+        self._idle = deque()
+        self._waiters = deque()
+        self.started = 0
+        self.running = 0
+        self.waiting = 0
+        self.max_in_flight = 0
+        self.waits = deque(maxlen=200)
+        self.run_times = deque(maxlen=200)
+        self.counters = {'submitted': 0, 'completed': 0, 'failed': 0, 'timed_out': 0, 'cancelled': 0, 'recycled': 0}
+
+    async def _acquire(self):
+        while True:
+            while self._idle:
+                worker = self._idle.popleft()
+                if worker.returncode is None:
+                    return worker
+                self._retire(worker)
+            if self.started < self.workers:
+                self.started += 1
+                try:
+                    return await asyncio.create_subprocess_exec(
+                        sys.executable, EXTRACT_WORKER_SCRIPT, json.dumps(self.warm_options),
+                        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, limit=EXTRACT_MAX_REPLY_BYTES)
+                except BaseException:
+                    self.started -= 1
+                    raise
+            # Resolves with an idle worker, or with None once a retired worker frees a slot.
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                worker = await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled() and waiter.result() is not None:
+                    self._release(waiter.result())
+                raise
+            if worker is not None:
+                return worker
+
+    def _wake_waiter(self, worker) -> bool:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(worker)
+                return True
+        return False
+
+    def _release(self, worker):
+        if not self._wake_waiter(worker):
+            self._idle.append(worker)
+
+    def _retire(self, worker):
+        if worker is None:
+            return
+        if worker.returncode is None:
+            worker.kill()
+        self.started -= 1
+        self.counters['recycled'] += 1
+        self._wake_waiter(None)
+
+    async def _request(self, worker, query: str, ydl_opts: dict) -> dict:
+        worker.stdin.write((json.dumps({'query': query, 'opts': ydl_opts}) + "\n").encode())
+        await worker.stdin.drain()
+        line = await worker.stdout.readline()
+        if not line:
+            raise ExtractionError("extraction worker exited unexpectedly")
+        return json.loads(line)
+
+    async def extract(self, query: str, ydl_opts: dict) -> dict:
+        started = time.perf_counter()
+        self.counters['submitted'] += 1
+        self.waiting += 1
+        self.max_in_flight = max(self.max_in_flight, self.waiting + self.running)
+        worker = None
+        try:
+            try:
+                worker = await asyncio.wait_for(self._acquire(), self.timeout)
+            finally:
+                self.waiting -= 1
+            waited = time.perf_counter() - started
+            self.running += 1
+            try:
+                reply = await asyncio.wait_for(self._request(worker, query, ydl_opts), self.timeout - waited)
+            finally:
+                self.running -= 1
+        except asyncio.TimeoutError:
+            self._retire(worker)
+            self.counters['timed_out'] += 1
+            raise ExtractionTimeout(f"extraction took longer than {self.timeout:.0f}s")
+        except asyncio.CancelledError:
+            self._retire(worker)
+            self.counters['cancelled'] += 1
+            raise
+        except Exception:
+            self._retire(worker)
+            self.counters['failed'] += 1
+            raise
+        self._release(worker)
+        if 'error' in reply:
+            self.counters['failed'] += 1
+            raise ExtractionError(reply['error'])
+        self.counters['completed'] += 1
+        self.waits.append(waited)
+        self.run_times.append(reply['seconds'])
+        return reply['info']
+
+    def stats(self) -> dict:
+        waits, run_times = sorted(self.waits), sorted(self.run_times)
+        return {
+            'workers': self.started,
+            'queued': self.waiting,
+            'running': self.running,
+            'max_in_flight': self.max_in_flight,
+            'avg_wait': sum(waits) / len(waits) if waits else 0.0,
+            'p95_run': run_times[int(0.95 * (len(run_times) - 1))] if run_times else 0.0,
+            **self.counters,
+        }
+
+EXTRACTION_POOL = ExtractionPool(EXTRACT_WORKERS, EXTRACT_TIMEOUT, [SEARCH_OPTS, STREAM_OPTS])
+
 async def search_ytdlp_async(query, ydl_opts):
+    return await EXTRACTION_POOL.extract(query, ydl_opts)
+
+# --- TRACK CACHE ---
+# A SQLite file that survives restarts and lets repeated songs skip yt-dlp. It holds three
+# tables. `searches` maps a normalized search query to a video, kept for
+# TRACK_SEARCH_TTL. `streams` maps a video to its stream URL, kept until the URL
+# expires. `spotify` maps a Spotify track, album or playlist to its search queries
+# (see SPOTIFY INGESTION). Each table keeps at most its configured number of rows, and
+# evicts the least recently used rows first. Every read, write, commit and eviction
+# runs on the cache's own single thread, which owns the connection, so a slow disk
+# never stalls the event loop.
+TRACK_CACHE_PATH = os.getenv("TRACK_CACHE_PATH", "track_cache.sqlite3")
+TRACK_SEARCH_TTL = float(os.getenv("TRACK_SEARCH_TTL_SECONDS", 30 * 24 * 3600))
+TRACK_CACHE_MAX_SEARCHES = int(os.getenv("TRACK_CACHE_MAX_SEARCHES", 20000))
+TRACK_CACHE_MAX_STREAMS = int(os.getenv("TRACK_CACHE_MAX_STREAMS", 2000))
+TRACK_CACHE_MAX_SPOTIFY = int(os.getenv("TRACK_CACHE_MAX_SPOTIFY", 2000))
+
+class TrackCache:
+    def __init__(self, path: str, max_searches: int, max_streams: int, max_spotify: int):
+        self.max_rows = {'searches': max_searches, 'streams': max_streams, 'spotify': max_spotify}
+        self.counters = {'search_hits': 0, 'search_misses': 0, 'stream_hits': 0, 'stream_misses': 0,
+                         'spotify_hits': 0, 'spotify_misses': 0, 'expired': 0, 'evicted': 0}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="aura-track-cache")
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS searches (query TEXT PRIMARY KEY, video_id TEXT, webpage_url TEXT, title TEXT, "
+                        "duration REAL, expires_at REAL, last_used REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS streams (video_key TEXT PRIMARY KEY, stream_url TEXT, expires_at REAL, last_used REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS spotify (source TEXT PRIMARY KEY, snapshot_id TEXT, queries TEXT, expires_at REAL, last_used REAL)")
+        for table in self.max_rows:
+            self.db.execute(f"CREATE INDEX IF NOT EXISTS {table}_last_used ON {table} (last_used)")
+        self.db.commit()
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(query.lower().split())
+
+    async def _run(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, method, *args)
+
+    def _get(self, table: str, key_column: str, key: str, columns: str, min_remaining: float = 0.0):
+        row = self.db.execute(f"SELECT {columns}, expires_at FROM {table} WHERE {key_column} = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[-1] - time.time() <= min_remaining:
+            self.db.execute(f"DELETE FROM {table} WHERE {key_column} = ?", (key,))
+            self.db.commit()
+            self.counters['expired'] += 1
+            return None
+        self.db.execute(f"UPDATE {table} SET last_used = ? WHERE {key_column} = ?", (time.time(), key))
+        self.db.commit()
+        return row[:-1]
+
+    def _evict(self, table: str):
+        excess = self.db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] - self.max_rows[table]
+        if excess > 0:
+            self.db.execute(f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} ORDER BY last_used LIMIT ?)", (excess,))
+            self.counters['evicted'] += excess
+
+    async def get_search(self, query: str) -> Optional[dict]:
+        return await self._run(self._get_search, query)
+
+    async def put_search(self, query: str, song: dict):
+        await self._run(self._put_search, query, song)
+
+    async def get_stream(self, video_key: str, min_remaining: float) -> Optional[tuple]:
+        return await self._run(self._get_stream, video_key, min_remaining)
+
+    async def put_stream(self, video_key: str, stream_url: str, expires_at: float):
+        await self._run(self._put_stream, video_key, stream_url, expires_at)
+
+    async def get_spotify(self, source: str, snapshot_id: str) -> Optional[List[str]]:
+        return await self._run(self._get_spotify, source, snapshot_id)
+
+    async def put_spotify(self, source: str, snapshot_id: str, queries: List[str]):
+        await self._run(self._put_spotify, source, snapshot_id, queries)
+
+    async def stats(self) -> dict:
+        return await self._run(self._stats)
+
+    def _get_search(self, query: str) -> Optional[dict]:
+        row = self._get('searches', 'query', self.normalize(query), "video_id, webpage_url, title, duration")
+        self.counters['search_hits' if row else 'search_misses'] += 1
+        if row is None:
+            return None
+        return {'video_id': row[0], 'webpage_url': row[1], 'title': row[2], 'duration': row[3]}
+
+    def _put_search(self, query: str, song: dict):
+        now = time.time()
+        self.db.execute("INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (self.normalize(query), song.get('video_id'), song['webpage_url'], song['title'],
+                         song.get('duration'), now + TRACK_SEARCH_TTL, now))
+        self._evict('searches')
+        self.db.commit()
+
+    def _get_stream(self, video_key: str, min_remaining: float) -> Optional[tuple]:
+        row = self._get('streams', 'video_key', video_key, "stream_url", min_remaining)
+        self.counters['stream_hits' if row else 'stream_misses'] += 1
+        return row
+
+    def _put_stream(self, video_key: str, stream_url: str, expires_at: float):
+        self.db.execute("INSERT OR REPLACE INTO streams VALUES (?, ?, ?, ?)", (video_key, stream_url, expires_at, time.time()))
+        self._evict('streams')
+        self.db.commit()
+
+    def _get_spotify(self, source: str, snapshot_id: str) -> Optional[List[str]]:
+        # A playlist edit changes its snapshot_id, which makes the stored entry stale.
+        row = self._get('spotify', 'source', source, "snapshot_id, queries")
+        hit = row is not None and row[0] == snapshot_id
+        self.counters['spotify_hits' if hit else 'spotify_misses'] += 1
+        return json.loads(row[1]) if hit else None
+
+    def _put_spotify(self, source: str, snapshot_id: str, queries: List[str]):
+        now = time.time()
+        self.db.execute("INSERT OR REPLACE INTO spotify VALUES (?, ?, ?, ?, ?)",
+                        (source, snapshot_id, json.dumps(queries), now + TRACK_SEARCH_TTL, now))
+        self._evict('spotify')
+        self.db.commit()
+
+    def _stats(self) -> dict:
+        return {
+            table: self.db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in self.max_rows
+        } | self.counters
+
+TRACK_CACHE = TrackCache(TRACK_CACHE_PATH, TRACK_CACHE_MAX_SEARCHES, TRACK_CACHE_MAX_STREAMS, TRACK_CACHE_MAX_SPOTIFY)
+
+# --- SPOTIFY INGESTION ---
+# spotipy blocks, so every call runs on SPOTIFY_EXECUTOR. Its SPOTIFY_CONCURRENCY
+# threads also cap how many pages are fetched at once. Playlists (100 per page) and
+# albums (50 per page) are read in full: the first page reports the total, then all
+# remaining pages are fetched together. A page that fails with a 429, a 5xx or a
+# network error is tried up to RETRY_MAX_ATTEMPTS times, waiting as long as Spotify's
+# Retry-After asks (at most SPOTIFY_MAX_RETRY_AFTER_SECONDS) or else the usual jittered
+# backoff; if it still fails, the tracks from the other pages are queued anyway. The resulting search queries are stored in TRACK_CACHE
+# (whose reads and writes run on its own thread), but only when every page arrived
+# and at least one track was found. A playlist entry is reused only while the
+# playlist's snapshot_id is unchanged, which costs one small request to check. Albums
+# and tracks don't change, so they are served from the cache with no request at all.
+SPOTIFY_CONCURRENCY = int(os.getenv("SPOTIFY_CONCURRENCY", 4))
+SPOTIFY_MAX_RETRY_AFTER_SECONDS = float(os.getenv("SPOTIFY_MAX_RETRY_AFTER_SECONDS", 30))
+SPOTIFY_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=SPOTIFY_CONCURRENCY, thread_name_prefix="aura-spotify")
+SPOTIFY_URL_PATTERN = re.compile(r"spotify\.com/(?:intl-[a-z]+/)?(track|album|playlist)/([A-Za-z0-9]+)")
+
+async def spotify_call(method, *args, **kwargs):
     loop = asyncio.get_running_loop()
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        return await loop.run_in_executor(None, lambda: ydl.extract_info(query, download=False))
+    return await loop.run_in_executor(SPOTIFY_EXECUTOR, lambda: method(*args, **kwargs))
+
+def spotify_search_query(track) -> Optional[str]:
+    if not track or not track.get('name') or not track.get('artists'):
+        return None
+    return f"{track['name']} {track['artists'][0]['name']}"
+
+def spotify_retry_delay(error: Exception, n: int) -> Optional[float]:
+    # How long to wait before retrying, or None if retrying won't help.
+    if isinstance(error, SpotifyException):
+        if error.http_status == 429:
+            retry_after = (error.headers or {}).get('Retry-After', '')
+            if not str(retry_after).isdigit():
+                return backoff_delay(n)
+            return float(retry_after) if float(retry_after) <= SPOTIFY_MAX_RETRY_AFTER_SECONDS else None
+        return backoff_delay(n) if error.http_status >= 500 else None
+    return backoff_delay(n)
+
+async def fetch_page_with_retries(fetch_page, offset: int):
+    for n in range(RETRY_MAX_ATTEMPTS):
+        try:
+            return await fetch_page(offset)
+        except Exception as e:
+            delay = spotify_retry_delay(e, n)
+            if delay is None or n == RETRY_MAX_ATTEMPTS - 1:
+                raise
+            print(f"Spotify page at offset {offset} failed ({e}), retrying in {delay:.1f}s.")
+            await asyncio.sleep(delay)
+
+async def fetch_all_pages(fetch_page, page_size: int):
+    # Returns (items, complete). complete is False if a page after the first was lost.
+    first_page = await fetch_page_with_retries(fetch_page, 0)
+    offsets = range(page_size, first_page['total'], page_size)
+    rest = await asyncio.gather(*(fetch_page_with_retries(fetch_page, offset) for offset in offsets), return_exceptions=True)
+    pages = [first_page]
+    for offset, page in zip(offsets, rest):
+        if isinstance(page, Exception):
+            print(f"Skipping the Spotify page at offset {offset}: {page}")
+        else:
+            pages.append(page)
+    return [item for page in pages for item in page.get('items') or []], len(pages) == len(offsets) + 1
 
-def get_spotify_tracks(query):
-    if not spotify or "spotify.com" not in query:
+async def get_spotify_tracks(query) -> List[str]:
+    match = SPOTIFY_URL_PATTERN.search(query) if spotify else None
+    if not match:
         return []
-    songs = []
+    kind, spotify_id = match.groups()
     try:
-        if "track" in query:
-            track = spotify.track(query)
-            songs.append(f"{track['name']} {track['artists'][0]['name']}")
-        elif "playlist" in query:
-            results = spotify.playlist_tracks(query)
-            for item in results.get('items', []):
-                track = item.get('track')
-                if track:
-                    songs.append(f"{track['name']} {track['artists'][0]['name']}")
-        elif "album" in query:
-            results = spotify.album_tracks(query)
-            for track in results.get('items', []):
-                if track:
-                    songs.append(f"{track['name']} {track['artists'][0]['name']}")
+        snapshot_id = ""
+        if kind == 'playlist':
+            snapshot_id = (await spotify_call(spotify.playlist, spotify_id, fields="snapshot_id"))['snapshot_id']
+        cached = await TRACK_CACHE.get_spotify(f"{kind}:{spotify_id}", snapshot_id)
+        if cached is not None:
+            return cached
+        complete = True
+        if kind == 'track':
+            tracks = [await spotify_call(spotify.track, spotify_id)]
+        elif kind == 'playlist':
+            items, complete = await fetch_all_pages(lambda offset: spotify_call(
+                spotify.playlist_items, spotify_id, offset=offset, limit=100,
+                fields="total,items(track(name,artists(name)))", additional_types=("track",)), 100)
+            tracks = [item.get('track') for item in items]
+        else:
+            tracks, complete = await fetch_all_pages(lambda offset: spotify_call(spotify.album_tracks, spotify_id, limit=50, offset=offset), 50)
+        songs = [q for q in map(spotify_search_query, tracks) if q]
     except Exception as e:
         print(f"Error fetching Spotify data: {e}")
         return []
+    if songs and complete:
+        await TRACK_CACHE.put_spotify(f"{kind}:{spotify_id}", snapshot_id, songs)
     return songs
 
+# --- TRACK PREFETCH ---
+# Resolving a track's stream URL takes yt-dlp a few seconds. While one song plays,
+# the next PREFETCH_AHEAD songs in the queue are resolved in the background, so the
+# next song can start as soon as the current one ends. Stream URLs expire (YouTube
+# puts an `expire=` timestamp in them), so a prefetched URL is only used while it is
+# valid for at least STREAM_URL_EXPIRY_MARGIN more seconds; otherwise it is resolved again.
+PREFETCH_AHEAD = int(os.getenv("PREFETCH_AHEAD", 2))
+STREAM_URL_EXPIRY_MARGIN = float(os.getenv("STREAM_URL_EXPIRY_MARGIN_SECONDS", 300))
+STREAM_URL_DEFAULT_TTL = float(os.getenv("STREAM_URL_DEFAULT_TTL_SECONDS", 3600))
+FFMPEG_OPTIONS = {"before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5", "options": "-vn"}
+PREFETCH_STATS = {'prefetched': 0, 'hits': 0, 'waited': 0, 'expired': 0, 'misses': 0, 'failed': 0}
+
+def stream_url_expiry(audio_url: str) -> float:
+    expire = parse_qs(urlparse(audio_url).query).get('expire')
+    if expire and expire[0].isdigit():
+        return float(expire[0])
+    return time.time() + STREAM_URL_DEFAULT_TTL
+
+async def resolve_stream_url(song: dict) -> str:
+    video_key = song.get('video_id') or song['webpage_url']
+    cached = await TRACK_CACHE.get_stream(video_key, STREAM_URL_EXPIRY_MARGIN)
+    if cached:
+        audio_url = cached[0]
+    else:
+        stream_results = await search_ytdlp_async(song['webpage_url'], STREAM_OPTS)
+        audio_url = stream_results['url']
+        await TRACK_CACHE.put_stream(video_key, audio_url, stream_url_expiry(audio_url))
+    song['stream_url'], song['stream_expires'] = audio_url, stream_url_expiry(audio_url)
+    return audio_url
+
+def stream_url_valid(song: dict) -> bool:
+    return 'stream_url' in song and song['stream_expires'] - time.time() > STREAM_URL_EXPIRY_MARGIN
+
+async def prefetch_song(song: dict):
+    try:
+        await resolve_stream_url(song)
+        PREFETCH_STATS['prefetched'] += 1
+    except Exception as e:
+        PREFETCH_STATS['failed'] += 1
+        print(f"Prefetch failed for '{song['title']}': {e}")
+
+def prefetch_upcoming(guild_id: str):
+    for song in list(SONG_QUEUES.get(guild_id, ()))[:PREFETCH_AHEAD]:
+        task = song.get('prefetch')
+        if (task is None or task.done()) and not stream_url_valid(song):
+            song['prefetch'] = asyncio.create_task(prefetch_song(song))
+
+async def get_stream_url(song: dict) -> str:
+    task = song.pop('prefetch', None)
+    if task is not None and not task.done():
+        PREFETCH_STATS['waited'] += 1
+        await task
+    if stream_url_valid(song):
+        PREFETCH_STATS['hits'] += 1
+        return song['stream_url']
+    PREFETCH_STATS['expired' if 'stream_url' in song else 'misses'] += 1
+    return await resolve_stream_url(song)
+
+# --- PLAYLIST RESOLUTION ---
+# Each track of a Spotify playlist needs its own YouTube search. All searches start
+# at once, with at most TRACK_SEARCH_CONCURRENCY running at a time. Playback starts
+# as soon as the first track is found. The remaining tracks are added to the queue in
+# a background task, in playlist order, and their progress is shown by editing one
+# status message.
+TRACK_SEARCH_CONCURRENCY = int(os.getenv("TRACK_SEARCH_CONCURRENCY", 5))
+track_search_semaphore = asyncio.Semaphore(TRACK_SEARCH_CONCURRENCY)
+playlist_tasks = {}
+
+async def search_track(query: str) -> Optional[dict]:
+    song = await TRACK_CACHE.get_search(query)
+    if song:
+        return song
+    async with track_search_semaphore:
+        results = await search_ytdlp_async(f"ytsearch1:{query}", SEARCH_OPTS)
+    if not results or not results.get('entries'):
+        return None
+    video_info = results['entries'][0]
+    song = {'video_id': video_info.get("id"), 'webpage_url': video_info.get("url"),
+            'title': video_info.get("title", "Untitled"), 'duration': video_info.get("duration")}
+    await TRACK_CACHE.put_search(query, song)
+    return song
+
+def playlist_status_embed(progress: dict, finished: bool) -> discord.Embed:
+    description = f"First up: **{progress['first']}**\nQueued **{progress['queued']}**/{progress['total']} tracks"
+    if progress['failed']:
+        description += f" | {progress['failed']} not found"
+    if finished:
+        return discord.Embed(title="✅ Playlist Queued", description=description, color=THEME_COLOR_BLUE)
+    return discord.Embed(title="⏳ Loading Playlist", description=description, color=THEME_COLOR_YELLOW)
+
+async def queue_playlist_tracks(voice_client, guild_id, channel, lookups, status_message, progress):
+    try:
+        for query, lookup in lookups:
+            try:
+                song = await lookup
+            except Exception as e:
+                print(f"Could not fetch '{query}': {e}")
+                song = None
+            if not voice_client.is_connected():
+                break
+            if song is None:
+                progress['failed'] += 1
+            else:
+                SONG_QUEUES.setdefault(guild_id, deque()).append(song)
+                progress['queued'] += 1
+                if voice_client.is_playing() or voice_client.is_paused():
+                    prefetch_upcoming(guild_id)
+                else:
+                    await play_next_song(voice_client, guild_id, channel)
+            OUTBOUND.edit(status_message, embed=playlist_status_embed(progress, finished=False))
+    finally:
+        for _, lookup in lookups:
+            lookup.cancel()
+        OUTBOUND.edit(status_message, embed=playlist_status_embed(progress, finished=True))
+
+def start_playlist_loading(guild_id: str, *args):
+    task = asyncio.create_task(queue_playlist_tracks(*args))
+    playlist_tasks.setdefault(guild_id, set()).add(task)
+    task.add_done_callback(lambda _: playlist_tasks.get(guild_id, set()).discard(task))
+
+def cancel_playlist_loading(guild_id: str):
+    for task in playlist_tasks.pop(guild_id, ()):
+        task.cancel()
+
 # --- UI Modals and Views ---
 class VolumeModal(discord.ui.Modal, title="Set Volume"):
     volume_input = discord.ui.TextInput(label="Volume Level (1-100)", placeholder="e.g., 50 for 50% volume", min_length=1, max_length=3)
@@ -155,13 +887,14 @@ class MusicControls(discord.ui.View):
     async def stop(self, interaction: discord.Interaction, button: discord.ui.Button):
         voice_client = interaction.guild.voice_client
         guild_id = str(interaction.guild_id)
+        cancel_playlist_loading(guild_id)
         if guild_id in SONG_QUEUES: SONG_QUEUES[guild_id].clear()
         if voice_client and voice_client.is_connected():
             voice_client.stop()
             await voice_client.disconnect()
             await interaction.response.send_message("Stopped and left the channel.", ephemeral=True)
             if guild_id in NOW_PLAYING_MESSAGES and NOW_PLAYING_MESSAGES[guild_id]:
-                try: await NOW_PLAYING_MESSAGES[guild_id].delete()
+                try: await OUTBOUND.delete(NOW_PLAYING_MESSAGES[guild_id])
                 except discord.NotFound: pass
                 NOW_PLAYING_MESSAGES[guild_id] = None
 
@@ -170,6 +903,7 @@ class MusicControls(discord.ui.View):
         queue = SONG_QUEUES.get(str(interaction.guild_id))
         if queue and len(queue) > 1:
             random.shuffle(queue)
+            prefetch_upcoming(str(interaction.guild_id))
             await interaction.response.send_message("Queue shuffled!", ephemeral=True)
         else:
             await interaction.response.send_message("Not enough songs to shuffle.", ephemeral=True)
@@ -194,10 +928,125 @@ intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 intents.guilds = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+
+class AuraBot(commands.Bot):
+    async def close(self):
+        # Runs inside the event loop on shutdown, while async resources can still be closed.
+        await super().close()
+        await close_http_session()
+
+bot = AuraBot(command_prefix="!", intents=intents)
+
+# --- CONVERSATION HISTORY STORE ---
+# Per-user chat history with hard limits: at most MAX_CHAT_SESSIONS users (least
+# recently used evicted first), a turn and byte budget per user (oldest turns trimmed
+# first, uploaded images included), and idle sessions dropped after SESSION_IDLE_TTL.
+MAX_CHAT_SESSIONS = int(os.getenv("MAX_CHAT_SESSIONS", 500))
+MAX_SESSION_TURNS = int(os.getenv("MAX_SESSION_TURNS", 30))
+MAX_SESSION_BYTES = int(os.getenv("MAX_SESSION_BYTES", 4 * 1024 * 1024))
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL_SECONDS", 3600))
+# Opens the user turn that compaction puts at the start of a history.
+SUMMARY_HEADER = "[Summary of our earlier conversation]"
+
+def estimate_content_bytes(content) -> int:
+    return sum(len(part.text.encode('utf-8')) + len(part.inline_data.data) for part in content.parts)
+
+def estimate_content_tokens(content) -> int:
+    # Roughly 4 characters per token; Gemini bills every image as a flat 258 tokens.
+    return sum(len(part.text) // 4 + (258 if part.inline_data.data else 0) for part in content.parts)
+
+class SessionStore:
+    def __init__(self, max_sessions: int, max_turns: int, max_bytes: int, idle_ttl: float):
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self._sessions = OrderedDict()
+        self.total_bytes = 0
+        self.counters = {'evicted': 0, 'expired': 0, 'trimmed_turns': 0}
+
+    def get(self, user_id):
+        entry = self._sessions.get(user_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry['last_used'] > self.idle_ttl:
+            self.pop(user_id)
+            self.counters['expired'] += 1
+            return None
+        self._sessions.move_to_end(user_id)
+        return entry
+
+    def peek(self, user_id):
+        # Like get(), for background work: it doesn't count as the user being active.
+        entry = self._sessions.get(user_id)
+        if entry is None or time.monotonic() - entry['last_used'] > self.idle_ttl:
+            return None
+        return entry
+
+    def _fit(self, history) -> tuple:
+        history = list(history)
+        sizes = [estimate_content_bytes(content) for content in history]
+        # A compaction summary stands in for everything before it, so it stays pinned
+        # at the front and only the turns after it are trimmed.
+        first = history[0].parts[0].text if history and history[0].parts else ""
+        start = 2 if first.startswith(SUMMARY_HEADER) and history[0].role == "user" else 0
+        # Drop whole user/model turns so the history still starts with the user.
+        while len(history) > start and (len(history) > self.max_turns * 2 or sum(sizes) > self.max_bytes):
+            del history[start:start + 2], sizes[start:start + 2]
+            self.counters['trimmed_turns'] += 1
+        return history, sum(sizes), sum(estimate_content_tokens(content) for content in history)
+
+    def put(self, user_id, history, **fields):
+        history, size, tokens = self._fit(history)
+        self.pop(user_id)
+        entry = {'history': history, 'bytes': size, 'tokens': tokens, 'last_used': time.monotonic(), **fields}
+        self._sessions[user_id] = entry
+        self.total_bytes += entry['bytes']
+        self._evict()
+        return entry
+
+    def replace_history(self, user_id, history):
+        # Swaps in a rewritten history but keeps the session's place in the LRU order,
+        # its last_used time and its other fields.
+        entry = self.peek(user_id)
+        if entry is None:
+            return None
+        history, size, tokens = self._fit(history)
+        self.total_bytes += size - entry['bytes']
+        entry.update(history=history, bytes=size, tokens=tokens)
+        return entry
+
+    def pop(self, user_id):
+        entry = self._sessions.pop(user_id, None)
+        if entry is not None:
+            self.total_bytes -= entry['bytes']
+        return entry
+
+    def _evict(self):
+        now = time.monotonic()
+        # Entries are kept in least-recently-used order, so idle ones sit at the front.
+        while self._sessions:
+            user_id, entry = next(iter(self._sessions.items()))
+            if now - entry['last_used'] > self.idle_ttl:
+                self.pop(user_id)
+                self.counters['expired'] += 1
+            elif len(self._sessions) > self.max_sessions:
+                self.pop(user_id)
+                self.counters['evicted'] += 1
+            else:
+                break
+
+    def footprint(self) -> dict:
+        return {
+            'sessions': len(self._sessions),
+            'turns': sum(len(entry['history']) // 2 for entry in self._sessions.values()),
+            'tokens': sum(entry['tokens'] for entry in self._sessions.values()),
+            'bytes': self.total_bytes,
+            **self.counters,
+        }
 
 # --- STATE MANAGEMENT & CONFIGS ---
-conversation_history = {}
+conversation_history = SessionStore(MAX_CHAT_SESSIONS, MAX_SESSION_TURNS, MAX_SESSION_BYTES, SESSION_IDLE_TTL)
 SECRET_REMINDERS = {}
 DEFAULT_MODE = "study_search"
 
@@ -270,94 +1119,1598 @@ async def handle_privileged_error(interaction: discord.Interaction, error: app_c
             ephemeral=True
         )
 
-# --- HELPER FUNCTIONS ---
-async def send_long_response(interaction_or_message, text, embed=None):
-    is_interaction = isinstance(interaction_or_message, discord.Interaction)
-    
-    if embed:
-        if len(text) <= 4096:
-            embed.description = text
-            if is_interaction:
-                if interaction_or_message.response.is_done():
-                    await interaction_or_message.followup.send(embed=embed)
-                else:
-                    await interaction_or_message.response.send_message(embed=embed)
-            else:
-                await interaction_or_message.channel.send(embed=embed)
+# --- AI REQUEST SCHEDULER ---
+# Every Gemini call takes a slot from AI_SCHEDULER first. At most AI_MAX_CONCURRENCY
+# calls run at once. Waiting requests are picked by weighted fair queuing: across
+# guilds by the guild's 'ai_weight' (default 1), then across users inside the guild.
+# A user's requests run one at a time. Once AI_MAX_USER_QUEUE are waiting, a new chat
+# message is merged into the last waiting one and anything else is turned away.
+# Slash commands ride a higher-priority lane than passive chat. Their interaction token
+# dies 15 minutes after the command, so a request that can no longer answer in time is
+# dropped from the queue, or cut off if it is already running.
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", max(4, 2 * len(api_keys))))
+AI_MAX_USER_QUEUE = int(os.getenv("AI_MAX_USER_QUEUE", 2))
+AI_BUSY_MESSAGE = "You've already got a few requests waiting with me. Give me a moment to catch up! 😅"
+AI_QUEUED_REACTION = "⏳"
+AI_MERGED_REACTION = "➕"
+AI_PRIORITY_INTERACTION = 0
+AI_PRIORITY_CHAT = 1
+INTERACTION_LIFETIME = timedelta(minutes=15)
+INTERACTION_DEADLINE_MARGIN = 20
+
+class AIQueueFull(Exception):
+    pass
+
+class AIRequestMerged(Exception):
+    pass
+
+class AIRequestExpired(Exception):
+    pass
+
+def ai_lane(interaction: Optional[discord.Interaction]):
+    if interaction is None:
+        return AI_PRIORITY_CHAT, None
+    # Keep a margin so there is still time to post the answer once it arrives.
+    remaining = (interaction.created_at + INTERACTION_LIFETIME - discord.utils.utcnow()).total_seconds()
+    return AI_PRIORITY_INTERACTION, time.monotonic() + remaining - INTERACTION_DEADLINE_MARGIN
+
+class AIJob:
+    def __init__(self, guild_id: int, user_id: int, prompt: str = None, images: list = None, mergeable: bool = False,
+                 priority: int = AI_PRIORITY_CHAT, deadline: Optional[float] = None):
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.prompt = prompt
+        self.images = list(images or [])
+        self.mergeable = mergeable
+        self.priority = priority
+        self.deadline = deadline
+        self.merged = 0
+        self.started = False
+        self.enqueued_at = time.monotonic()
+        self.dispatched = asyncio.get_running_loop().create_future()
+        # The caller may have given up before the job expires in the queue, so nobody would
+        # read the AIRequestExpired set on it; mark it read so asyncio doesn't log it.
+        self.dispatched.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def check_deadline(self):
+        if self.expired():
+            raise AIRequestExpired()
+
+    async def within_deadline(self, aw):
+        if self.deadline is None:
+            return await aw
+        try:
+            return await asyncio.wait_for(aw, max(0.0, self.deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            raise AIRequestExpired()
+
+class FairScheduler:
+    def __init__(self, max_concurrency: int, max_user_queue: int):
+        self.max_concurrency = max_concurrency
+        self.max_user_queue = max_user_queue
+        self.running = 0
+        self._guilds = {}
+        self._vtime = 0.0
+        self.counters = {'submitted': 0, 'dispatched': 0, 'merged': 0, 'dropped': 0, 'expired': 0, 'borrowed': 0}
+        self.lane_counts = {AI_PRIORITY_INTERACTION: 0, AI_PRIORITY_CHAT: 0}
+        self.wait_times = deque(maxlen=500)
+
+    def guild_weight(self, guild_id: int) -> float:
+        return max(0.1, float(server_configs.get(str(guild_id), {}).get('ai_weight', 1)))
+
+    def submit(self, job: AIJob):
+        guild = self._guilds.setdefault(job.guild_id, {'vtime': self._vtime, 'user_clock': 0.0, 'users': {}})
+        user = guild['users'].setdefault(job.user_id, {'vtime': guild['user_clock'], 'jobs': deque(), 'running': 0})
+        if len(user['jobs']) >= self.max_user_queue:
+            last = user['jobs'][-1] if user['jobs'] else None
+            if job.mergeable and last is not None and last.mergeable and last.priority == job.priority:
+                last.prompt = f"{last.prompt}\n{job.prompt}"
+                last.images.extend(job.images)
+                last.merged += 1
+                self.counters['merged'] += 1
+                raise AIRequestMerged()
+            self.counters['dropped'] += 1
+            self._cleanup(job.guild_id, job.user_id)
+            raise AIQueueFull()
+        user['jobs'].append(job)
+        self.counters['submitted'] += 1
+        self._dispatch()
+
+    def release(self, job: AIJob):
+        guild = self._guilds.get(job.guild_id)
+        user = guild['users'].get(job.user_id) if guild else None
+        if user is not None:
+            if job.started:
+                self.running -= 1
+                user['running'] -= 1
+            elif job in user['jobs']:
+                user['jobs'].remove(job)
+                if job.expired():
+                    self.counters['expired'] += 1
+            self._cleanup(job.guild_id, job.user_id)
+        self._dispatch()
+
+    def _cleanup(self, guild_id: int, user_id: int):
+        guild = self._guilds.get(guild_id)
+        if guild is None:
             return
+        user = guild['users'].get(user_id)
+        if user is not None and not user['jobs'] and not user['running']:
+            del guild['users'][user_id]
+        if not guild['users']:
+            del self._guilds[guild_id]
+
+    def _purge_expired(self):
+        for guild in self._guilds.values():
+            for user in guild['users'].values():
+                for job in [j for j in user['jobs'] if j.expired()]:
+                    user['jobs'].remove(job)
+                    self.counters['expired'] += 1
+                    if not job.dispatched.done():
+                        job.dispatched.set_exception(AIRequestExpired())
+
+    def _pop_next(self) -> Optional[AIJob]:
+        self._purge_expired()
+        ready = [u for g in self._guilds.values() for u in g['users'].values() if u['jobs'] and not u['running']]
+        if not ready:
+            return None
+        # Serve the most urgent lane first, then share it fairly across guilds and users.
+        lane = min(j.priority for u in ready for j in u['jobs'])
+        in_lane = lambda u: u['jobs'] and not u['running'] and any(j.priority == lane for j in u['jobs'])
+        best_id, best_guild = None, None
+        for guild_id, guild in self._guilds.items():
+            if not any(in_lane(u) for u in guild['users'].values()):
+                continue
+            if best_guild is None or guild['vtime'] < best_guild['vtime']:
+                best_id, best_guild = guild_id, guild
+        user = min((u for u in best_guild['users'].values() if in_lane(u)), key=lambda u: u['vtime'])
+        job = next(j for j in user['jobs'] if j.priority == lane)
+        user['jobs'].remove(job)
+        self._vtime = best_guild['vtime']
+        best_guild['vtime'] += 1 / self.guild_weight(best_id)
+        best_guild['user_clock'] = user['vtime']
+        user['vtime'] += 1
+        user['running'] += 1
+        return job
+
+    def _dispatch(self):
+        while self.running < self.max_concurrency:
+            job = self._pop_next()
+            if job is None:
+                break
+            job.started = True
+            self.running += 1
+            self.counters['dispatched'] += 1
+            self.lane_counts[job.priority] += 1
+            self.wait_times.append(time.monotonic() - job.enqueued_at)
+            if not job.dispatched.done():
+                job.dispatched.set_result(True)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, guild_id: int, user_id: int, prompt: str = None, images: list = None,
+                   mergeable: bool = False, status_message: discord.Message = None,
+                   interaction: discord.Interaction = None):
+        priority, deadline = ai_lane(interaction)
+        job = AIJob(guild_id, user_id, prompt, images, mergeable, priority, deadline)
+        job.check_deadline()
+        try:
+            self.submit(job)
+        except AIRequestMerged:
+            await set_message_status(status_message, AI_MERGED_REACTION, True)
+            raise
+        queued = not job.started
+        try:
+            if queued:
+                await set_message_status(status_message, AI_QUEUED_REACTION, True)
+                await job.within_deadline(asyncio.shield(job.dispatched))
+                await set_message_status(status_message, AI_QUEUED_REACTION, False)
+                queued = False
+            yield job
+        finally:
+            self.release(job)
+            if queued:
+                await set_message_status(status_message, AI_QUEUED_REACTION, False)
+
+    def try_borrow(self) -> bool:
+        # Takes a free slot without queuing, for extra work on behalf of a running job
+        # (a hedged backup call). Every free slot means nothing is waiting to use it.
+        if self.running >= self.max_concurrency:
+            return False
+        self.running += 1
+        self.counters['borrowed'] += 1
+        return True
+
+    def give_back(self):
+        self.running -= 1
+        self._dispatch()
+
+    def stats(self) -> dict:
+        waiting = sum(len(u['jobs']) for g in self._guilds.values() for u in g['users'].values())
+        avg_wait = sum(self.wait_times) / len(self.wait_times) if self.wait_times else 0.0
+        return {'running': self.running, 'waiting': waiting, 'guilds': len(self._guilds), 'avg_wait': avg_wait,
+                'interaction_lane': self.lane_counts[AI_PRIORITY_INTERACTION], 'chat_lane': self.lane_counts[AI_PRIORITY_CHAT],
+                **self.counters}
+
+async def set_message_status(message: Optional[discord.Message], emoji: str, active: bool):
+    if message is None:
+        return
+    try:
+        if active:
+            await message.add_reaction(emoji)
         else:
-            embed.description = text[:4093] + "..."
-            if is_interaction:
-                if interaction_or_message.response.is_done():
-                    await interaction_or_message.followup.send(embed=embed)
-                else:
-                    await interaction_or_message.response.send_message(embed=embed)
-            else:
-                await interaction_or_message.channel.send(embed=embed)
-            text = text[4093:]
+            await message.remove_reaction(emoji, bot.user)
+    except discord.HTTPException:
+        pass
+
+AI_SCHEDULER = FairScheduler(AI_MAX_CONCURRENCY, AI_MAX_USER_QUEUE)
+
+# --- IMAGE PREPROCESSING ---
+# Uploaded images are checked, shrunk and re-encoded on IMAGE_EXECUTOR instead of the
+# event loop. The format is sniffed from the file's magic bytes before anything is
+# decoded. Images are downsampled to IMAGE_MAX_DIMENSION (JPEGs decode straight at a
+# reduced scale), metadata is dropped by re-encoding to JPEG, and quality steps down
+# until the result fits in IMAGE_MAX_BYTES. Gemini gets the compact JPEG, not the
+# original upload.
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", 1536))
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", 1_500_000))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", 85))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))
+IMAGE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="aura-image")
+IMAGE_STAGES = ('sniff', 'decode', 'resize', 'encode')
+IMAGE_STAGE_TIMINGS = {stage: deque(maxlen=200) for stage in IMAGE_STAGES}
+IMAGE_STATS = {'processed': 0, 'rejected': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+class ImageRejected(Exception):
+    pass
+
+def sniff_image_format(data: bytes) -> Optional[str]:
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'GIF'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'WEBP'
+    if data.startswith(b'BM'):
+        return 'BMP'
+    return None
 
-    chunks = [text[i:i + 2000] for i in range(0, len(text), 2000)]
-    
-    for i, chunk in enumerate(chunks):
-        if i == 0 and not embed:
-            if is_interaction:
-                if interaction_or_message.response.is_done():
-                    await interaction_or_message.followup.send(chunk)
-                else:
-                    await interaction_or_message.response.send_message(chunk)
-            else:
-                await interaction_or_message.reply(chunk)
+def preprocess_image(data: bytes):
+    timings = {}
+    started = time.perf_counter()
+
+    fmt = sniff_image_format(data)
+    if fmt is None:
+        raise ImageRejected("unsupported image format")
+    try:
+        # Image.open only parses the header; pixel data isn't decoded until load().
+        img = Image.open(io.BytesIO(data))
+    except (Image.UnidentifiedImageError, Image.DecompressionBombError) as e:
+        raise ImageRejected(str(e))
+    if img.format != fmt:
+        raise ImageRejected(f"file claims to be {fmt} but decodes as {img.format}")
+    timings['sniff'], started = time.perf_counter() - started, time.perf_counter()
+
+    if img.format == 'JPEG':
+        img.draft('RGB', (IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        img = background
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+    timings['decode'], started = time.perf_counter() - started, time.perf_counter()
+
+    img.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+    timings['resize'], started = time.perf_counter() - started, time.perf_counter()
+
+    quality = IMAGE_JPEG_QUALITY
+    while True:
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=quality, optimize=True)
+        if buffer.tell() <= IMAGE_MAX_BYTES:
+            break
+        if quality > 50:
+            quality -= 15
+        elif min(img.size) > 256:
+            img = img.resize((int(img.width * 0.75), int(img.height * 0.75)), Image.LANCZOS)
         else:
-            await interaction_or_message.channel.send(chunk)
+            raise ImageRejected("image is still too large after compression")
+    timings['encode'] = time.perf_counter() - started
 
+    return {'mime_type': 'image/jpeg', 'data': buffer.getvalue()}, timings
 
-async def ask_aura_ai(prompt: str, user_id: int, guild_id: int, images: List[Image.Image] = None):
+async def preprocess_image_async(data: bytes) -> dict:
+    loop = asyncio.get_running_loop()
     try:
-        genai.configure(api_key=get_next_api_key())
+        blob, timings = await loop.run_in_executor(IMAGE_EXECUTOR, preprocess_image, data)
+    except ImageRejected:
+        IMAGE_STATS['rejected'] += 1
+        raise
+    for stage, seconds in timings.items():
+        IMAGE_STAGE_TIMINGS[stage].append(seconds)
+    IMAGE_STATS['processed'] += 1
+    IMAGE_STATS['bytes_in'] += len(data)
+    IMAGE_STATS['bytes_out'] += len(blob['data'])
+    return blob
+
+# --- ATTACHMENT DOWNLOADS ---
+# Attachments are checked against their Discord metadata (size, content type) before
+# anything is fetched, then downloaded concurrently, at most ATTACHMENT_DOWNLOAD_CONCURRENCY
+# at a time across the bot. Bodies are streamed into a buffer capped at ATTACHMENT_MAX_BYTES,
+# so a file whose metadata lies about its size is cut off, not read into memory.
+ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", 10 * 1024 * 1024))
+ATTACHMENT_DOWNLOAD_CONCURRENCY = int(os.getenv("ATTACHMENT_DOWNLOAD_CONCURRENCY", 4))
+ATTACHMENT_DOWNLOAD_TIMEOUT_SECONDS = float(os.getenv("ATTACHMENT_DOWNLOAD_TIMEOUT_SECONDS", 30))
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+attachment_download_semaphore = asyncio.Semaphore(ATTACHMENT_DOWNLOAD_CONCURRENCY)
+http_session: Optional[aiohttp.ClientSession] = None
+
+class AttachmentRejected(Exception):
+    pass
+
+def is_image_attachment(attachment: discord.Attachment) -> bool:
+    # content_type is None when Discord couldn't work it out.
+    return (attachment.content_type or '').startswith('image/')
+
+def get_http_session() -> aiohttp.ClientSession:
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=ATTACHMENT_DOWNLOAD_TIMEOUT_SECONDS))
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+async def download_attachment(attachment: discord.Attachment) -> bytes:
+    if attachment.size > ATTACHMENT_MAX_BYTES:
+        raise AttachmentRejected(f"{attachment.filename} is {attachment.size / 1048576:.1f} MiB, over the {ATTACHMENT_MAX_BYTES / 1048576:.0f} MiB limit")
+    if attachment.content_type and not attachment.content_type.startswith('image/'):
+        raise AttachmentRejected(f"{attachment.filename} is not an image ({attachment.content_type})")
+    async with attachment_download_semaphore:
+        async with get_http_session().get(attachment.url) as resp:
+            resp.raise_for_status()
+            buffer = bytearray()
+            async for chunk in resp.content.iter_chunked(ATTACHMENT_CHUNK_SIZE):
+                buffer.extend(chunk)
+                if len(buffer) > ATTACHMENT_MAX_BYTES:
+                    raise AttachmentRejected(f"{attachment.filename} is larger than its metadata claimed")
+    return bytes(buffer)
+
+async def load_image_attachments(attachments: List[discord.Attachment]):
+    # Returns (images, errors), keeping the images in attachment order.
+    async def load(attachment):
+        return await preprocess_image_async(await download_attachment(attachment))
+    results = await asyncio.gather(*(load(a) for a in attachments), return_exceptions=True)
+    images = [r for r in results if not isinstance(r, BaseException)]
+    errors = [r for r in results if isinstance(r, BaseException)]
+    return images, errors
+
+# --- OUTBOUND DISPATCHER ---
+# Every send, reply, follow-up, edit and delete goes through OUTBOUND. Each channel has
+# its own queue and worker, so a busy channel never holds up a quiet one. Each queue
+# paces itself against Discord's per-channel route buckets (ROUTE_BUCKETS) rather
+# than running into 429s and discord.py's retry sleeps. The buckets outlive the queue:
+# a channel's worker exits once its queue is empty, but its buckets keep their tokens
+# until they have sat unused for ROUTE_BUCKET_IDLE_SECONDS, by which time they would
+# have refilled anyway. While an edit is still queued, a later edit to the same message
+# replaces it, so only the newest text goes out. Interaction responses (defer,
+# response.send_message) skip the queue, because Discord needs them within 3 seconds.
+ROUTE_BUCKETS = {'send': (5, 5.0), 'edit': (5, 5.0), 'delete': (5, 1.0), 'followup': (5, 2.0)}
+ROUTE_BUCKET_IDLE_SECONDS = max(per for _, per in ROUTE_BUCKETS.values())
+
+class RouteBucket:
+    def __init__(self, capacity: int, per: float):
+        self.capacity = capacity
+        self.rate = capacity / per
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        # Takes a token if one is free, otherwise returns how long to wait for the next.
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class OutboundDispatcher:
+    def __init__(self):
+        self._channels = {}
+        self._buckets = {}
+        self._last_sweep = time.monotonic()
+        self.delays = deque(maxlen=500)
+        self.counters = {'sent': 0, 'edited': 0, 'deleted': 0, 'coalesced': 0, 'throttled': 0, 'skipped': 0}
+
+    def _channel(self, channel_id: int) -> dict:
+        state = self._channels.get(channel_id)
+        if state is None:
+            state = {'queue': deque(), 'worker': None}
+            self._channels[channel_id] = state
+        return state
+
+    def _bucket(self, channel_id: int, route: str) -> RouteBucket:
+        now = time.monotonic()
+        if now - self._last_sweep >= ROUTE_BUCKET_IDLE_SECONDS:
+            self._last_sweep = now
+            for idle_id in [cid for cid, b in self._buckets.items()
+                            if cid not in self._channels and now - b['used'] >= ROUTE_BUCKET_IDLE_SECONDS]:
+                del self._buckets[idle_id]
+        buckets = self._buckets.get(channel_id)
+        if buckets is None:
+            buckets = {'routes': {r: RouteBucket(*limits) for r, limits in ROUTE_BUCKETS.items()}, 'used': now}
+            self._buckets[channel_id] = buckets
+        buckets['used'] = now
+        return buckets['routes'][route]
+
+    def _submit(self, channel_id: int, route: str, call, kwargs: dict, **extra) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        # Fire-and-forget callers never read the result, so don't let asyncio complain about it.
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        state = self._channel(channel_id)
+        state['queue'].append({'route': route, 'call': call, 'kwargs': kwargs, 'futures': [future],
+                               'enqueued_at': time.monotonic(), **extra})
+        if state['worker'] is None or state['worker'].done():
+            state['worker'] = asyncio.create_task(self._drain(channel_id, state))
+        return future
+
+    async def _drain(self, channel_id: int, state: dict):
+        queue = state['queue']
+        while queue:
+            op = queue[0]
+            wait = self._bucket(channel_id, op['route']).reserve()
+            if wait > 0:
+                self.counters['throttled'] += 1
+                await asyncio.sleep(wait)
+                continue
+            queue.popleft()
+            if all(f.done() for f in op['futures']):
+                # Everyone waiting on it was cancelled.
+                self.counters['skipped'] += 1
+                continue
+            self.delays.append(time.monotonic() - op['enqueued_at'])
+            try:
+                result = await op['call'](**op['kwargs'])
+            except Exception as e:
+                for f in op['futures']:
+                    if not f.done():
+                        f.set_exception(e)
+                continue
+            self.counters[{'send': 'sent', 'followup': 'sent', 'edit': 'edited', 'delete': 'deleted'}[op['route']]] += 1
+            for f in op['futures']:
+                if not f.done():
+                    f.set_result(result)
+        if not queue:
+            self._channels.pop(channel_id, None)
+
+    def send(self, channel, **kwargs) -> asyncio.Future:
+        return self._submit(channel.id, 'send', channel.send, kwargs)
+
+    def reply(self, message: discord.Message, **kwargs) -> asyncio.Future:
+        return self._submit(message.channel.id, 'send', message.reply, kwargs)
+
+    def followup(self, interaction: discord.Interaction, **kwargs) -> asyncio.Future:
+        return self._submit(interaction.channel_id, 'followup', interaction.followup.send, {'wait': True, **kwargs})
+
+    def edit(self, message: discord.Message, **kwargs) -> asyncio.Future:
+        state = self._channel(message.channel.id)
+        for op in state['queue']:
+            if op['route'] == 'edit' and op.get('message_id') == message.id:
+                op['kwargs'].update(kwargs)
+                future = asyncio.get_running_loop().create_future()
+                future.add_done_callback(lambda f: f.cancelled() or f.exception())
+                op['futures'].append(future)
+                self.counters['coalesced'] += 1
+                return future
+        return self._submit(message.channel.id, 'edit', message.edit, kwargs, message_id=message.id)
+
+    def delete(self, message: discord.Message) -> asyncio.Future:
+        return self._submit(message.channel.id, 'delete', message.delete, {})
+
+    def stats(self) -> dict:
+        delays = sorted(self.delays)
+        return {
+            'channels': len(self._channels),
+            'buckets': len(self._buckets),
+            'queued': sum(len(s['queue']) for s in self._channels.values()),
+            'avg_delay': sum(delays) / len(delays) if delays else 0.0,
+            'p95_delay': delays[int(0.95 * (len(delays) - 1))] if delays else 0.0,
+            **self.counters,
+        }
+
+OUTBOUND = OutboundDispatcher()
 
-        guild_id_str = str(guild_id)
-        current_mode = server_configs.get(guild_id_str, {}).get('mode', DEFAULT_MODE)
-        
-        system_instruction = ""
-        temperature = 0.7
-        
-        if current_mode == 'sfw_freaky':
-            system_instruction = "You are a Discord bot with a flirty, cheeky, and slightly freaky personality. You maintain a SFW (Safe For Work) boundary. Be conversational, engaging, and playful. Do not use asterisks."
-            temperature = 0.7
-        elif current_mode == 'nsfw_freaky':
-            system_instruction = "You are a Discord bot with a flirty, cheeky, and explicitly NSFW personality. You are unrestrained, use strong language, and make suggestive or direct adult-themed jokes. Be creative, bold, and do not hold back. Do not use asterisks."
-            temperature = 1.0
-        else:
-            system_instruction = "You are Aura, a helpful and professional AI assistant. Provide clear, informative, and friendly responses to assist the user."
-            temperature = 0.3
+# --- HELPER FUNCTIONS ---
+# Replies are cut into Discord-sized chunks in a single pass. Each cut prefers, in
+# order: a paragraph break, a line break, the end of a sentence, a space, and only
+# then a hard cut. A hard cut never splits an emoji sequence or a combining mark from
+# its base character. A chunk that ends inside a fenced code block is closed with
+# ``` and the next chunk reopens it in the same language. The first chunk may be an
+# embed description (4096 characters); every later chunk is a plain message (2000).
+# ResponseChunker takes text incrementally, so streaming can feed it as it arrives.
+EMBED_DESCRIPTION_LIMIT = 4096
+MESSAGE_LIMIT = 2000
+CHUNK_BREAKS = ("\n\n", "\n", ". ", "! ", "? ", " ")
+CODE_FENCE_PATTERN = re.compile(r"^ {0,3}(```|~~~)([^\s`]*)", re.MULTILINE)
+
+def is_regional_indicator(ch: str) -> bool:
+    return '\U0001F1E6' <= ch <= '\U0001F1FF'
+
+def continues_grapheme(text: str, i: int) -> bool:
+    # True if cutting before text[i] would split a character from what it attaches to.
+    ch, prev = text[i], text[i - 1]
+    if prev == '\u200d' or ch in '\u200d\ufe0e\ufe0f' or unicodedata.combining(ch):
+        return True
+    if '\U0001F3FB' <= ch <= '\U0001F3FF' or '\U000E0020' <= ch <= '\U000E007F':
+        return True
+    if is_regional_indicator(ch) and is_regional_indicator(prev):
+        # Flags are pairs; only cut between pairs.
+        run = 0
+        while i - 1 - run >= 0 and is_regional_indicator(text[i - 1 - run]):
+            run += 1
+        return run % 2 == 1
+    return False
 
-        generation_config = genai.types.GenerationConfig(temperature=temperature)
+class ResponseChunker:
+    def __init__(self, with_embed: bool = False):
+        self._buffer = ""
+        self._limit = EMBED_DESCRIPTION_LIMIT if with_embed else MESSAGE_LIMIT
+        self._open_fence = None
+        self.chunks = []
+
+    def feed(self, text: str) -> List[str]:
+        # Returns the chunks this text completed; they won't change as more text arrives.
+        self._buffer += text
+        completed = []
+        while True:
+            chunk = self._cut()
+            if chunk is None:
+                break
+            completed.append(chunk)
+        self.chunks.extend(completed)
+        return completed
+
+    def tail(self) -> str:
+        # The unfinished last chunk, as it would be sent right now.
+        return self._prefix() + self._buffer
+
+    def close(self) -> List[str]:
+        tail = self.tail()
+        self._buffer = ""
+        self._open_fence = None
+        if tail.strip():
+            self.chunks.append(tail)
+            return [tail]
+        return []
 
-        model_name = 'gemini-1.5-pro-latest' if current_mode == 'study_search' else 'gemini-1.5-flash'
-        model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
-        
-        user_convo_data = conversation_history.get(user_id)
-        
-        if user_convo_data and user_convo_data['model'] == model_name:
-            chat_session = user_convo_data['session']
+    def _prefix(self) -> str:
+        return self._open_fence + "\n" if self._open_fence else ""
+
+    def _cut(self) -> Optional[str]:
+        buffer, prefix = self._buffer, self._prefix()
+        room = self._limit - len(prefix)
+        if len(buffer) <= room:
+            return None
+        # Leave space to close a code block, in case the cut lands inside one.
+        room -= 4
+        cut = None
+        for separator in CHUNK_BREAKS:
+            at = buffer.rfind(separator, room // 2, room)
+            if at != -1:
+                cut = at + len(separator)
+                break
+        if cut is None:
+            cut = room
+            while cut > 1 and continues_grapheme(buffer, cut):
+                cut -= 1
+
+        fence = self._open_fence
+        for match in CODE_FENCE_PATTERN.finditer(buffer, 0, cut):
+            if fence is None:
+                fence = match.group(1) + match.group(2)
+            elif match.group(1) == fence[:3] and not match.group(2):
+                fence = None
+        chunk = prefix + buffer[:cut].rstrip()
+        if fence:
+            chunk += "\n" + fence[:3]
+        self._open_fence = fence
+        self._buffer = buffer[cut:]
+        self._limit = MESSAGE_LIMIT
+        return chunk if chunk.strip() else self._cut()
+
+def iter_response_chunks(text: str, with_embed: bool = False):
+    chunker = ResponseChunker(with_embed)
+    yield from chunker.feed(text)
+    yield from chunker.close()
+
+async def send_first_response(interaction_or_message, **kwargs):
+    if isinstance(interaction_or_message, discord.Interaction):
+        if interaction_or_message.response.is_done():
+            return await OUTBOUND.followup(interaction_or_message, **kwargs)
+        await interaction_or_message.response.send_message(**kwargs)
+        return await interaction_or_message.original_response()
+    if 'embed' in kwargs:
+        return await OUTBOUND.send(interaction_or_message.channel, **kwargs)
+    return await OUTBOUND.reply(interaction_or_message, **kwargs)
+
+async def send_long_response(interaction_or_message, text, embed=None):
+    for i, segment in enumerate(iter_response_chunks(text, with_embed=embed is not None)):
+        if i == 0 and embed is not None:
+            embed.description = segment
+            await send_first_response(interaction_or_message, embed=embed)
+        elif i == 0:
+            await send_first_response(interaction_or_message, content=segment)
         else:
-            chat_session = model.start_chat(history=[])
-            conversation_history[user_id] = {'session': chat_session, 'model': model_name}
+            await OUTBOUND.send(interaction_or_message.channel, content=segment)
+
+# --- STREAMING RESPONSES ---
+# Posts the first message as soon as the model starts answering and edits it as more
+# text arrives, at most once every STREAM_EDIT_INTERVAL seconds to stay clear of
+# Discord's edit rate limit. The text goes through a ResponseChunker as it streams, so
+# chunks that are already complete are cut once, and only the last message changes.
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() == "true"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL_SECONDS", 1.5))
+STREAM_CURSOR = " ▌"
+
+async def stream_long_response(interaction_or_message, text_stream, embed=None) -> str:
+    pieces = []
+    chunker = ResponseChunker(with_embed=embed is not None)
+    messages, shown = [], []
+
+    async def flush(final: bool):
+        tail = chunker.tail()
+        segments = chunker.chunks + ([tail] if tail.strip() else [])
+        for i, segment in enumerate(segments):
+            limit = EMBED_DESCRIPTION_LIMIT if i == 0 and embed is not None else MESSAGE_LIMIT
+            is_live = not final and i == len(segments) - 1
+            display = segment + STREAM_CURSOR if is_live and len(segment) + len(STREAM_CURSOR) <= limit else segment
+            if i < len(shown) and shown[i] == display:
+                continue
+            if i == 0 and embed is not None:
+                embed.description = display
+                kwargs = {'embed': embed}
+            else:
+                kwargs = {'content': display}
+            if i < len(messages):
+                # Intermediate edits aren't awaited; if the channel is backed up, the
+                # dispatcher folds them into the next one. The final edit is awaited.
+                edit = OUTBOUND.edit(messages[i], **kwargs)
+                if final:
+                    await edit
+                shown[i] = display
+            elif i == 0:
+                messages.append(await send_first_response(interaction_or_message, **kwargs))
+                shown.append(display)
+            else:
+                messages.append(await OUTBOUND.send(interaction_or_message.channel, **kwargs))
+                shown.append(display)
+
+    last_flush = 0.0
+    async for chunk in text_stream:
+        pieces.append(chunk)
+        chunker.feed(chunk)
+        if time.monotonic() - last_flush >= STREAM_EDIT_INTERVAL and (chunker.chunks or chunker.tail().strip()):
+            await flush(final=False)
+            last_flush = time.monotonic()
+    chunker.close()
+    if chunker.chunks:
+        await flush(final=True)
+    return "".join(pieces)
+
+# --- MODEL ROUTING ---
+# The model is chosen per request, not fixed per mode. Study mode prefers the pro model,
+# but trivial messages ("hi", "thanks") go to flash, and so does everything while pro
+# is erroring or slower than ROUTING_MAX_LATENCY_SECONDS. Images, code and real
+# questions stay on pro. A guild can pin either model with /model_policy.
+MODEL_PRO = 'gemini-1.5-pro-latest'
+MODEL_FLASH = 'gemini-1.5-flash'
+MODEL_POLICIES = ('auto', 'pro', 'flash')
+ROUTING_SIMPLE_PROMPT_CHARS = int(os.getenv("ROUTING_SIMPLE_PROMPT_CHARS", 80))
+ROUTING_MAX_ERROR_RATE = float(os.getenv("ROUTING_MAX_ERROR_RATE", 0.5))
+ROUTING_MAX_LATENCY_SECONDS = float(os.getenv("ROUTING_MAX_LATENCY_SECONDS", 20))
+ROUTING_WINDOW = 50
+ROUTING_MIN_SAMPLES = 5
+ROUTING_PROBE_INTERVAL_SECONDS = 30
+COMPLEX_PROMPT_PATTERN = re.compile(
+    r"```|\b(why|how|explain|compare|difference|prove|derive|analy[sz]e|calculate|solve|"
+    r"step[- ]by[- ]step|summari[sz]e|write|code|essay|pros and cons)\b|\d\s*[-+*/^=]\s*\d",
+    re.IGNORECASE
+)
 
-        message_parts = [prompt]
-        if images:
-            message_parts.extend(images)
+class ModelRouter:
+    def __init__(self):
+        self._latencies = {}
+        self._errors = {}
+        self.routes = {}
+        self._last_probe = {}
+
+    @contextlib.contextmanager
+    def measure(self, model_name: str):
+        # Times one call up to its first response: the whole reply normally, the first
+        # chunk when streaming. Cancelled calls aren't counted here; hedged_call records
+        # the primaries it cancels through record_censored.
+        started = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self._errors.setdefault(model_name, deque(maxlen=ROUTING_WINDOW)).append(True)
+            raise
+        self._latencies.setdefault(model_name, deque(maxlen=ROUTING_WINDOW)).append(time.monotonic() - started)
+        self._errors.setdefault(model_name, deque(maxlen=ROUTING_WINDOW)).append(False)
+
+    def record_censored(self, model_name: str, at_least: float):
+        # A call cancelled before it answered took at least this long. Dropping it would
+        # leave only the fast calls in the window and pull the percentiles down.
+        self._latencies.setdefault(model_name, deque(maxlen=ROUTING_WINDOW)).append(at_least)
+
+    def latency_percentile(self, model_name: str, pct: float) -> Optional[float]:
+        samples = sorted(self._latencies.get(model_name, ()))
+        if len(samples) < ROUTING_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(pct * len(samples)))]
+
+    def error_rate(self, model_name: str) -> float:
+        results = self._errors.get(model_name, ())
+        return sum(results) / len(results) if len(results) >= ROUTING_MIN_SAMPLES else 0.0
+
+    def healthy(self, model_name: str) -> bool:
+        p50 = self.latency_percentile(model_name, 0.5)
+        return self.error_rate(model_name) <= ROUTING_MAX_ERROR_RATE and (p50 is None or p50 <= ROUTING_MAX_LATENCY_SECONDS)
+
+    def probe_due(self, model_name: str) -> bool:
+        # An unhealthy model still gets one request every ROUTING_PROBE_INTERVAL_SECONDS,
+        # otherwise its stats could never recover.
+        now = time.monotonic()
+        if now - self._last_probe.get(model_name, 0.0) < ROUTING_PROBE_INTERVAL_SECONDS:
+            return False
+        self._last_probe[model_name] = now
+        return True
 
-        response = await chat_session.send_message_async(
-            content=message_parts,
-            generation_config=generation_config
-        )
+    @staticmethod
+    def is_complex(prompt: str, images: List[dict] = None) -> bool:
+        return bool(images) or len(prompt) > ROUTING_SIMPLE_PROMPT_CHARS or COMPLEX_PROMPT_PATTERN.search(prompt) is not None
+
+    def route(self, guild_id: int, prompt: str, images: List[dict], preferred: str) -> str:
+        policy = server_configs.get(str(guild_id), {}).get('model_policy', 'auto')
+        if policy == 'pro':
+            model_name, reason = MODEL_PRO, 'policy'
+        elif policy == 'flash':
+            model_name, reason = MODEL_FLASH, 'policy'
+        elif preferred != MODEL_PRO:
+            model_name, reason = preferred, 'mode'
+        elif not self.is_complex(prompt, images):
+            model_name, reason = MODEL_FLASH, 'simple'
+        elif get_model_breaker(MODEL_PRO).is_open():
+            model_name, reason = MODEL_FLASH, 'pro unhealthy'
+        elif not self.healthy(MODEL_PRO):
+            # Only claim the probe for a request that would have gone to pro anyway.
+            model_name, reason = (MODEL_PRO, 'probe') if self.probe_due(MODEL_PRO) else (MODEL_FLASH, 'pro unhealthy')
+        else:
+            model_name, reason = MODEL_PRO, 'complex'
+        route = f"{model_name} ({reason})"
+        self.routes[route] = self.routes.get(route, 0) + 1
+        return model_name
+
+    def stats(self) -> dict:
+        models = {}
+        for model_name in set(self._latencies) | set(self._errors):
+            models[model_name] = {
+                'p50': self.latency_percentile(model_name, 0.5),
+                'p95': self.latency_percentile(model_name, 0.95),
+                'error_rate': self.error_rate(model_name),
+            }
+        return {'routes': dict(self.routes), 'models': models}
+
+MODEL_ROUTER = ModelRouter()
+
+# --- HEDGED REQUESTS ---
+# If a call hasn't answered by the model's recent HEDGE_PERCENTILE latency, a backup
+# call is started alongside it. The backup runs on whichever key the scheduler picks,
+# which is usually another key since the primary is still holding its own. If the
+# primary was on pro, the backup uses flash. Whichever answers first wins and the
+# other is cancelled. Until a model has enough latency samples,
+# HEDGE_DEFAULT_DELAY_SECONDS is used instead. The backup needs a free AI_SCHEDULER
+# slot of its own; when every slot is taken the request isn't hedged. A primary that
+# is cancelled still counts toward its model's latency, as taking at least the time
+# it had been running.
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "true").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 0.95))
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv("HEDGE_MIN_DELAY_SECONDS", 2))
+HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv("HEDGE_DEFAULT_DELAY_SECONDS", 10))
+HEDGE_TO_FLASH = os.getenv("HEDGE_TO_FLASH", "true").lower() == "true"
+HEDGE_STATS = {'requests': 0, 'hedged': 0, 'skipped': 0, 'primary_wins': 0, 'backup_wins': 0, 'both_failed': 0}
+
+def hedge_delay(model_name: str) -> float:
+    latency = MODEL_ROUTER.latency_percentile(model_name, HEDGE_PERCENTILE)
+    return max(HEDGE_MIN_DELAY_SECONDS, latency if latency is not None else HEDGE_DEFAULT_DELAY_SECONDS)
+
+async def hedged_call(attempt, model_name: str, discard=None):
+    # attempt(model_name) makes one complete call. discard(result), if given, cleans up
+    # a call that finished but lost (e.g. releases the key a stream is holding).
+    HEDGE_STATS['requests'] += 1
+    started = time.monotonic()
+    primary = asyncio.create_task(attempt(model_name))
+    tasks = [primary]
+    winner = None
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_delay(model_name) if HEDGE_ENABLED else None)
+        if done:
+            winner = primary
+            return primary.result()
+
+        if not AI_SCHEDULER.try_borrow():
+            HEDGE_STATS['skipped'] += 1
+            await asyncio.wait(tasks)
+            winner = primary
+            return primary.result()
+
+        async def backup(backup_model: str):
+            try:
+                return await attempt(backup_model)
+            finally:
+                AI_SCHEDULER.give_back()
+
+        tasks.append(asyncio.create_task(backup(MODEL_FLASH if HEDGE_TO_FLASH and model_name == MODEL_PRO else model_name)))
+        HEDGE_STATS['hedged'] += 1
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((task for task in tasks if task in done and task.exception() is None), None)
+            if winner is not None:
+                HEDGE_STATS['primary_wins' if winner is primary else 'backup_wins'] += 1
+                return winner.result()
+        HEDGE_STATS['both_failed'] += 1
+        return primary.result()
+    finally:
+        for task in tasks:
+            if task is winner:
+                continue
+            if not task.done():
+                task.cancel()
+                if task is primary:
+                    MODEL_ROUTER.record_censored(model_name, time.monotonic() - started)
+            elif discard is not None and not task.cancelled() and task.exception() is None:
+                asyncio.create_task(discard(task.result()))
+
+def get_mode_settings(guild_id: int):
+    guild_id_str = str(guild_id)
+    current_mode = server_configs.get(guild_id_str, {}).get('mode', DEFAULT_MODE)
+    
+    system_instruction = ""
+    temperature = 0.7
+    
+    if current_mode == 'sfw_freaky':
+        system_instruction = "You are a Discord bot with a flirty, cheeky, and slightly freaky personality. You maintain a SFW (Safe For Work) boundary. Be conversational, engaging, and playful. Do not use asterisks."
+        temperature = 0.7
+    elif current_mode == 'nsfw_freaky':
+        system_instruction = "You are a Discord bot with a flirty, cheeky, and explicitly NSFW personality. You are unrestrained, use strong language, and make suggestive or direct adult-themed jokes. Be creative, bold, and do not hold back. Do not use asterisks."
+        temperature = 1.0
+    else:
+        system_instruction = "You are Aura, a helpful and professional AI assistant. Provide clear, informative, and friendly responses to assist the user."
+        temperature = 0.3
+
+    # This is only the mode's preferred model; MODEL_ROUTER makes the final call.
+    model_name = MODEL_PRO if current_mode == 'study_search' else MODEL_FLASH
+    return current_mode, system_instruction, temperature, model_name
+
+def get_user_history(user_id: int) -> list:
+    # Only the history is kept per user; the session itself is rebuilt on whichever
+    # client and model we check out, so a conversation never stays pinned to one key
+    # and survives the router switching models between turns.
+    user_convo_data = conversation_history.get(user_id)
+    return user_convo_data['history'] if user_convo_data else []
+
+def remember_exchange(user_id: int, model_name: str, prompt: str, images: List[dict], reply: str):
+    # Store an answer that never went through a chat session (a cache hit), so that
+    # follow-up questions still see it.
+    user_parts = [glm.Part(text=prompt), *(glm.Part(inline_data=glm.Blob(**image)) for image in images)]
+    history = get_user_history(user_id) + [
+        glm.Content(role='user', parts=user_parts),
+        glm.Content(role='model', parts=[glm.Part(text=reply)]),
+    ]
+    conversation_history.put(user_id, history, model=model_name)
+    schedule_compaction(user_id)
+
+async def ask_aura_ai(prompt: str, user_id: int, guild_id: int, images: List[dict] = None,
+                      mergeable: bool = False, status_message: discord.Message = None,
+                      interaction: discord.Interaction = None, cache_analysis: bool = False, on_start=None):
+    # Returns None if the interaction this answer was for expired before it was ready.
+    # on_start() is called once the request leaves the scheduler queue.
+    try:
+        current_mode, system_instruction, temperature, model_name = get_mode_settings(guild_id)
+        generation_config = genai.types.GenerationConfig(temperature=temperature)
+        cache_key = None
+        if cache_analysis:
+            cache_key = IMAGE_ANALYSIS_CACHE.make_key(prompt, model_name, current_mode, temperature, images)
+            cached = IMAGE_ANALYSIS_CACHE.get(cache_key)
+            if cached is not None:
+                remember_exchange(user_id, model_name, prompt, images, cached)
+                return cached
+
+        async with AI_SCHEDULER.slot(guild_id, user_id, prompt, images, mergeable, status_message, interaction) as job:
+            if on_start:
+                on_start()
+            # Read the history only once we're running; the user's previous reply is stored by then.
+            # Cached image analyses are shared between users, so they see neither.
+            history = [] if cache_analysis else get_user_history(user_id)
+            memory_note = None if cache_analysis else await recall_memories(user_id, job.prompt, history)
+            message_parts = [memory_note, job.prompt, *job.images] if memory_note else [job.prompt, *job.images]
+            routed_model = MODEL_ROUTER.route(guild_id, job.prompt, job.images, model_name)
+
+            async def attempt(attempt_model):
+                async with GEMINI_POOL.checkout() as client:
+                    model = client.get_model(attempt_model, system_instruction)
+                    chat_session = model.start_chat(history=history)
+                    with MODEL_ROUTER.measure(attempt_model):
+                        response = await chat_session.send_message_async(
+                            content=message_parts,
+                            generation_config=generation_config
+                        )
+                    return chat_session, response, attempt_model
+
+            chat_session, response, answered_by = await job.within_deadline(hedged_call(with_retries(attempt), routed_model))
+            if cache_analysis:
+                remember_exchange(user_id, answered_by, job.prompt, job.images, response.text)
+            else:
+                conversation_history.put(user_id, strip_memory_note(chat_session.history, memory_note), model=answered_by)
+        schedule_compaction(user_id)
+        if MEMORY_ENABLED:
+            LONG_TERM_MEMORY.add_in_background(user_id, job.prompt, response.text)
+        if cache_key:
+            IMAGE_ANALYSIS_CACHE.put(cache_key, response.text)
         return response.text
 
+    except AIRequestMerged:
+        raise
+    except AIQueueFull:
+        return AI_BUSY_MESSAGE
+    except CircuitOpenError:
+        return AI_UNAVAILABLE_MESSAGE
+    except AIRequestExpired:
+        print(f"Dropped an AI request for user {user_id}: its interaction expired.")
+        return None
     except Exception as e:
         print(f"An error occurred while calling the Gemini API: {e}")
         return "Sorry, I encountered an error while thinking. Please try again."
 
+async def ask_aura_ai_stream(prompt: str, user_id: int, guild_id: int, images: List[dict] = None,
+                             mergeable: bool = False, status_message: discord.Message = None,
+                             interaction: discord.Interaction = None, cache_analysis: bool = False, on_start=None):
+    # Same as ask_aura_ai, but yields the reply piece by piece as the model produces it.
+    received_any = False
+    try:
+        current_mode, system_instruction, temperature, model_name = get_mode_settings(guild_id)
+        generation_config = genai.types.GenerationConfig(temperature=temperature)
+        cache_key = None
+        if cache_analysis:
+            cache_key = IMAGE_ANALYSIS_CACHE.make_key(prompt, model_name, current_mode, temperature, images)
+            cached = IMAGE_ANALYSIS_CACHE.get(cache_key)
+            if cached is not None:
+                remember_exchange(user_id, model_name, prompt, images, cached)
+                yield cached
+                return
+        pieces = []
+
+        async with AI_SCHEDULER.slot(guild_id, user_id, prompt, images, mergeable, status_message, interaction) as job:
+            if on_start:
+                on_start()
+            history = [] if cache_analysis else get_user_history(user_id)
+            memory_note = None if cache_analysis else await recall_memories(user_id, job.prompt, history)
+            message_parts = [memory_note, job.prompt, *job.images] if memory_note else [job.prompt, *job.images]
+            routed_model = MODEL_ROUTER.route(guild_id, job.prompt, job.images, model_name)
+
+            async def attempt(attempt_model):
+                # Only the wait for the first chunk is hedged. The winner keeps its key
+                # checked out (in the returned stack) for as long as it streams.
+                async with contextlib.AsyncExitStack() as stack:
+                    client = await stack.enter_async_context(GEMINI_POOL.checkout())
+                    model = client.get_model(attempt_model, system_instruction)
+                    chat_session = model.start_chat(history=history)
+                    with MODEL_ROUTER.measure(attempt_model):
+                        response = await chat_session.send_message_async(
+                            content=message_parts,
+                            generation_config=generation_config,
+                            stream=True
+                        )
+                    return stack.pop_all(), chat_session, response, attempt_model
+
+            stack, chat_session, response, answered_by = await job.within_deadline(
+                hedged_call(with_retries(attempt), routed_model, discard=lambda result: result[0].aclose())
+            )
+            async with stack:
+                async for chunk in response:
+                    job.check_deadline()
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        # Chunks that only carry a finish reason or safety ratings have no text.
+                        continue
+                    received_any = True
+                    pieces.append(text)
+                    yield text
+                if received_any:
+                    await response.resolve()
+            if not received_any:
+                # Same as response.text raising on a blocked reply: answer with the apology. Raised
+                # once the key is checked back in, so a blocked reply isn't counted against it.
+                raise ValueError("the response carried no text (blocked or empty)")
+            if cache_analysis:
+                remember_exchange(user_id, answered_by, job.prompt, job.images, "".join(pieces))
+            else:
+                conversation_history.put(user_id, strip_memory_note(chat_session.history, memory_note), model=answered_by)
+        schedule_compaction(user_id)
+        if MEMORY_ENABLED and pieces:
+            LONG_TERM_MEMORY.add_in_background(user_id, job.prompt, "".join(pieces))
+        if cache_key and pieces:
+            IMAGE_ANALYSIS_CACHE.put(cache_key, "".join(pieces))
+
+    except AIRequestMerged:
+        raise
+    except AIQueueFull:
+        yield AI_BUSY_MESSAGE
+    except CircuitOpenError:
+        yield AI_UNAVAILABLE_MESSAGE
+    except AIRequestExpired:
+        print(f"Dropped an AI request for user {user_id}: its interaction expired.")
+    except Exception as e:
+        print(f"An error occurred while streaming from the Gemini API: {e}")
+        if received_any:
+            yield "\n\n*(Sorry, I lost my train of thought there.)*"
+        else:
+            yield "Sorry, I encountered an error while thinking. Please try again."
+
+# --- RESPONSE CACHE ---
+# Answers for the stateless commands (/summarize, /brainstorm, /plan_my_day,
+# /prompt_maker), keyed by the normalized prompt plus the mode, its model and its
+# temperature. Routing happens after the lookup, so a hit never counts as a route.
+# Entries expire after RESPONSE_CACHE_TTL, the least recently used are evicted past
+# RESPONSE_CACHE_MAX_ENTRIES, and setting RESPONSE_CACHE_FILE keeps them across restarts.
+# A background task writes the file every RESPONSE_CACHE_SAVE_INTERVAL seconds, off the
+# event loop and only if something changed, and the bot writes it once more on shutdown.
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", 3600))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 1000))
+RESPONSE_CACHE_FILE = os.getenv("RESPONSE_CACHE_FILE", "")
+RESPONSE_CACHE_SAVE_INTERVAL = 60
+
+def normalize_prompt(prompt: str) -> str:
+    return " ".join(prompt.split()).casefold()
+
+class ResponseCache:
+    def __init__(self, max_entries: int, ttl: float, path: str = ""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self._entries = OrderedDict()
+        self._dirty = False
+        self._flusher = None
+        self.counters = {'hits': 0, 'misses': 0, 'evicted': 0, 'expired': 0}
+        if path:
+            self.load()
+
+    @staticmethod
+    def make_key(prompt: str, model_name: str, mode: str, temperature: float, images: List[dict] = None) -> str:
+        # Images go in by content hash, in order, since questions can refer to "the first one".
+        digests = [hashlib.sha256(image['data']).hexdigest() for image in images or []]
+        raw = json.dumps([normalize_prompt(prompt), model_name, mode, temperature, *digests])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is not None and entry['expires_at'] <= time.time():
+            del self._entries[key]
+            self.counters['expired'] += 1
+            entry = None
+        if entry is None:
+            self.counters['misses'] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.counters['hits'] += 1
+        return entry['text']
+
+    def put(self, key: str, text: str):
+        self._entries[key] = {'text': text, 'expires_at': time.time() + self.ttl}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.counters['evicted'] += 1
+        self._dirty = True
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                content = f.read()
+                entries = json.loads(content) if content else {}
+        except json.JSONDecodeError:
+            print(f"Warning: {self.path} is corrupted. Starting with an empty response cache.")
+            return
+        now = time.time()
+        live = sorted(((k, v) for k, v in entries.items() if v['expires_at'] > now), key=lambda kv: kv[1]['expires_at'])
+        self._entries = OrderedDict(live[-self.max_entries:])
+
+    def _write(self, entries: dict):
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump(entries, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def save(self):
+        if self.path and self._dirty:
+            self._write(self._entries)
+            self._dirty = False
+
+    async def flush(self):
+        if not self.path or not self._dirty:
+            return
+        # Entries are replaced, never changed in place, so a shallow copy is a stable snapshot.
+        snapshot = dict(self._entries)
+        self._dirty = False
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, snapshot)
+        except OSError as e:
+            self._dirty = True
+            print(f"Failed to save the response cache to {self.path}: {e}")
+
+    def start_flusher(self):
+        if self.path and (self._flusher is None or self._flusher.done()):
+            self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(RESPONSE_CACHE_SAVE_INTERVAL)
+            await self.flush()
+
+    def stats(self) -> dict:
+        lookups = self.counters['hits'] + self.counters['misses']
+        return {'entries': len(self._entries), 'hit_rate': self.counters['hits'] / lookups if lookups else 0.0, **self.counters}
+
+RESPONSE_CACHE = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_FILE)
+
+# /ask_image answers, keyed by the hashes of the preprocessed images plus the question.
+# Preprocessing is deterministic, so a reposted meme or screenshot hashes the same
+# every time it comes back, whoever posts it. The analysis itself is made without the
+# asker's history or memories, so the answer is safe to share; the exchange is then
+# added to the asker's history like any other.
+IMAGE_ANALYSIS_CACHE_TTL = float(os.getenv("IMAGE_ANALYSIS_CACHE_TTL_SECONDS", 6 * 3600))
+IMAGE_ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("IMAGE_ANALYSIS_CACHE_MAX_ENTRIES", 500))
+IMAGE_ANALYSIS_CACHE = ResponseCache(IMAGE_ANALYSIS_CACHE_MAX_ENTRIES, IMAGE_ANALYSIS_CACHE_TTL)
+
+# --- REQUEST COALESCING ---
+# When several people fire the same stateless prompt at once (everyone running
+# /summarize on the same message), only the first one goes upstream. The rest wait
+# for its answer instead of spending their own call. If the leader fails or is
+# cancelled, the first waiter to wake up takes over as the new leader and the others
+# wait for it in turn, so a failure never sends every waiter upstream at once.
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self.counters = {'leaders': 0, 'saved': 0, 'fallbacks': 0}
+
+    def join(self, key: str) -> Optional[asyncio.Future]:
+        return self._calls.get(key)
+
+    def lead(self, key: str) -> asyncio.Future:
+        flight = asyncio.get_running_loop().create_future()
+        self._calls[key] = flight
+        self.counters['leaders'] += 1
+        return flight
+
+    def finish(self, key: str, flight: asyncio.Future, result: Optional[str]):
+        if self._calls.get(key) is flight:
+            del self._calls[key]
+        if not flight.done():
+            flight.set_result(result)
+
+    def stats(self) -> dict:
+        return {'in_flight': len(self._calls), **self.counters}
+
+AI_SINGLE_FLIGHT = SingleFlight()
+
+async def ask_aura_ai_stateless_stream(prompt: str, user_id: int, guild_id: int, interaction: discord.Interaction = None):
+    # One-shot prompts that don't read or write the user's chat history, so their
+    # answers can be served from RESPONSE_CACHE without polluting the conversation.
+    # The cache is keyed by the mode's model; only a leader on a cache miss is routed.
+    received_any = False
+    try:
+        current_mode, system_instruction, temperature, model_name = get_mode_settings(guild_id)
+        cache_key = RESPONSE_CACHE.make_key(prompt, model_name, current_mode, temperature)
+        cached = RESPONSE_CACHE.get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+        # Nothing awaits between a failed leader's waiter waking up and calling lead(),
+        # so the waiters that wake after it find its flight and keep waiting.
+        while True:
+            flight = AI_SINGLE_FLIGHT.join(cache_key)
+            if flight is None:
+                break
+            shared = await asyncio.shield(flight)
+            if shared is not None:
+                AI_SINGLE_FLIGHT.counters['saved'] += 1
+                yield shared
+                return
+            AI_SINGLE_FLIGHT.counters['fallbacks'] += 1
+
+        flight = AI_SINGLE_FLIGHT.lead(cache_key)
+        pieces, result = [], None
+        try:
+            model_name = MODEL_ROUTER.route(guild_id, prompt, None, model_name)
+
+            async def attempt(attempt_model):
+                async with contextlib.AsyncExitStack() as stack:
+                    client = await stack.enter_async_context(GEMINI_POOL.checkout())
+                    model = client.get_model(attempt_model, system_instruction)
+                    with MODEL_ROUTER.measure(attempt_model):
+                        response = await model.generate_content_async(
+                            prompt,
+                            generation_config=genai.types.GenerationConfig(temperature=temperature),
+                            stream=True
+                        )
+                    return stack.pop_all(), response
+
+            async with AI_SCHEDULER.slot(guild_id, user_id, interaction=interaction) as job:
+                stack, response = await job.within_deadline(
+                    hedged_call(with_retries(attempt), model_name, discard=lambda result: result[0].aclose())
+                )
+                async with stack:
+                    async for chunk in response:
+                        job.check_deadline()
+                        try:
+                            text = chunk.text
+                        except ValueError:
+                            continue
+                        received_any = True
+                        pieces.append(text)
+                        yield text
+                if not received_any:
+                    raise ValueError("the response carried no text (blocked or empty)")
+            if pieces:
+                result = "".join(pieces)
+                RESPONSE_CACHE.put(cache_key, result)
+        finally:
+            AI_SINGLE_FLIGHT.finish(cache_key, flight, result)
+
+    except AIQueueFull:
+        yield AI_BUSY_MESSAGE
+    except CircuitOpenError:
+        yield AI_UNAVAILABLE_MESSAGE
+    except AIRequestExpired:
+        print(f"Dropped an AI request for user {user_id}: its interaction expired.")
+    except Exception as e:
+        print(f"An error occurred while calling the Gemini API: {e}")
+        if received_any:
+            yield "\n\n*(Sorry, I lost my train of thought there.)*"
+        else:
+            yield "Sorry, I encountered an error while thinking. Please try again."
+
+async def ask_aura_ai_stateless(prompt: str, user_id: int, guild_id: int, interaction: discord.Interaction = None) -> Optional[str]:
+    text = "".join([chunk async for chunk in ask_aura_ai_stateless_stream(prompt, user_id, guild_id, interaction)])
+    return text or None
+
+# --- HISTORY COMPACTION ---
+# Once a user's history passes COMPACTION_TOKEN_THRESHOLD, everything but the last
+# COMPACTION_KEEP_TURNS turns is folded into a single summary turn by the cheaper
+# COMPACTION_MODEL. It runs in the background after the reply has been sent, so the
+# prompt size stays roughly flat however long someone keeps chatting.
+COMPACTION_TOKEN_THRESHOLD = int(os.getenv("COMPACTION_TOKEN_THRESHOLD", 6000))
+COMPACTION_KEEP_TURNS = int(os.getenv("COMPACTION_KEEP_TURNS", 4))
+COMPACTION_MODEL = os.getenv("COMPACTION_MODEL", "gemini-1.5-flash")
+COMPACTION_STATS = {'runs': 0, 'failures': 0, 'discarded': 0, 'tokens_before': 0, 'tokens_after': 0}
+compaction_tasks = {}
+
+def history_to_transcript(history) -> str:
+    lines = []
+    for content in history:
+        speaker = "User" if content.role == "user" else "Aura"
+        text = " ".join(part.text for part in content.parts if part.text)
+        if any(part.inline_data.data for part in content.parts):
+            text += " [image]"
+        lines.append(f"{speaker}: {text}")
+    return "\n".join(lines)
+
+def schedule_compaction(user_id: int):
+    entry = conversation_history.peek(user_id)
+    if not entry or entry['tokens'] <= COMPACTION_TOKEN_THRESHOLD or user_id in compaction_tasks:
+        return
+    if len(entry['history']) <= COMPACTION_KEEP_TURNS * 2:
+        return
+    task = asyncio.create_task(compact_history(user_id, entry['history']))
+    compaction_tasks[user_id] = task
+    task.add_done_callback(lambda _: compaction_tasks.pop(user_id, None))
+
+async def compact_history(user_id: int, snapshot: list):
+    cut = len(snapshot) - COMPACTION_KEEP_TURNS * 2
+    old_turns = snapshot[:cut]
+    prompt = (
+        "Condense the following conversation between a user and Aura into a short summary written "
+        "in the third person. Keep facts about the user, names, preferences, open questions and "
+        "anything Aura promised to do. Leave out small talk.\n\n" + history_to_transcript(old_turns)
+    )
+    try:
+        async with GEMINI_POOL.checkout() as client:
+            model = client.get_model(COMPACTION_MODEL, None)
+            response = await model.generate_content_async(
+                prompt,
+                generation_config=genai.types.GenerationConfig(temperature=0.2)
+            )
+        summary = response.text.strip()
+    except Exception as e:
+        COMPACTION_STATS['failures'] += 1
+        print(f"History compaction failed for user {user_id}: {e}")
+        return
+
+    # The user may have kept chatting, been trimmed or been evicted while we summarized.
+    # Compaction isn't activity, so it must not move the session up the LRU order.
+    entry = conversation_history.peek(user_id)
+    if entry is None or entry['history'][:cut] != old_turns:
+        COMPACTION_STATS['discarded'] += 1
+        return
+    summary_turns = [
+        glm.Content(role="user", parts=[glm.Part(text=f"{SUMMARY_HEADER}\n{summary}")]),
+        glm.Content(role="model", parts=[glm.Part(text="Got it, I'll keep that in mind.")]),
+    ]
+    tokens_before = entry['tokens']
+    entry = conversation_history.replace_history(user_id, summary_turns + entry['history'][cut:])
+    COMPACTION_STATS['runs'] += 1
+    COMPACTION_STATS['tokens_before'] += tokens_before
+    COMPACTION_STATS['tokens_after'] += entry['tokens']
+
+
+# --- LONG-TERM MEMORY ---
+# Off unless MEMORY_ENABLED=true. When on, every chat exchange is embedded into a small
+# per-user vector index: a float32 NumPy matrix plus the matching snippets. When a new
+# message comes in, the MEMORY_TOP_K most similar past exchanges are added to the
+# prompt. Snippets of exchanges still in the live history are skipped, so the bot
+# remembers earlier conversations without resending them. Each user's index is written
+# to disk under MEMORY_DIR as <user>.npy and <user>.json and kept across restarts until
+# the user runs /forget_me; the .npy file is memory-mapped when loaded. Changed users
+# are written every MEMORY_SAVE_INTERVAL seconds and once more on shutdown. All file
+# writes and deletes run in order on the index's own thread, off the event loop. The
+# embedder is pluggable: "hashing" is local, free and deterministic; "gemini" uses
+# text-embedding-004.
+MEMORY_ENABLED = os.getenv("MEMORY_ENABLED", "false").lower() == "true"
+MEMORY_DIR = os.getenv("MEMORY_DIR", "memory_index")
+MEMORY_EMBEDDER = os.getenv("MEMORY_EMBEDDER", "hashing").lower()
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", 3))
+MEMORY_MIN_SCORE = float(os.getenv("MEMORY_MIN_SCORE", 0.25))
+MEMORY_MAX_ENTRIES = int(os.getenv("MEMORY_MAX_ENTRIES_PER_USER", 2000))
+MEMORY_MAX_LOADED_USERS = int(os.getenv("MEMORY_MAX_LOADED_USERS", 200))
+MEMORY_SNIPPET_CHARS = 600
+MEMORY_SAVE_INTERVAL = 60
+MEMORY_NOTE_HEADER = "[Things you remember from earlier conversations with this user]"
+MEMORY_TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+def memory_snippet(prompt: str, reply: str) -> str:
+    return f"User: {prompt}\nAura: {reply}"[:MEMORY_SNIPPET_CHARS]
+
+class HashingEmbedder:
+    # Feature-hashed word unigrams and bigrams. blake2b rather than hash(), which is
+    # salted per process and would scramble the saved index on every restart.
+    name = "hashing"
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def embed_one(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        words = MEMORY_TOKEN_PATTERN.findall(text.lower())
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            h = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+            vector[h % self.dim] += 1.0 if h >> 63 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        return np.stack([self.embed_one(text) for text in texts])
+
+class GeminiEmbedder:
+    name = "gemini"
+    dim = 768
+
+    def __init__(self, model_name: str = "text-embedding-004"):
+        self.model_name = model_name
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        async with GEMINI_POOL.checkout() as client:
+            vectors = np.asarray(await client.embed(self.model_name, texts), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+class MemoryIndex:
+    def __init__(self, directory: str, embedder):
+        self.directory = directory
+        self.embedder = embedder
+        self._users = OrderedDict()
+        self._dirty = set()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="aura-memory")
+        self._flusher = None
+        self._pending = {}
+        self.counters = {'stored': 0, 'searches': 0, 'recalled': 0, 'failures': 0}
+
+    def _paths(self, user_id: int):
+        return os.path.join(self.directory, f"{user_id}.npy"), os.path.join(self.directory, f"{user_id}.json")
+
+    def _load(self, user_id: int) -> dict:
+        memory = self._users.get(user_id)
+        if memory is not None:
+            self._users.move_to_end(user_id)
+            return memory
+        memory = {'vectors': np.zeros((0, self.embedder.dim), dtype=np.float32), 'snippets': []}
+        vectors_path, meta_path = self._paths(user_id)
+        if os.path.exists(vectors_path) and os.path.exists(meta_path):
+            try:
+                with open(meta_path, 'r') as f:
+                    meta = json.load(f)
+                vectors = np.load(vectors_path, mmap_mode='r')
+                if meta.get('embedder') == self.embedder.name and vectors.shape == (len(meta['snippets']), self.embedder.dim):
+                    memory = {'vectors': vectors, 'snippets': meta['snippets']}
+                else:
+                    print(f"Warning: memory index for user {user_id} was built with another embedder. Starting fresh.")
+            except (OSError, ValueError) as e:
+                print(f"Warning: memory index for user {user_id} is unreadable ({e}). Starting fresh.")
+        self._users[user_id] = memory
+        while len(self._users) > MEMORY_MAX_LOADED_USERS:
+            evicted_id, _ = next(iter(self._users.items()))
+            if evicted_id in self._dirty:
+                self._executor.submit(self._write, evicted_id, *self._snapshot(evicted_id)).add_done_callback(self._report_write)
+            del self._users[evicted_id]
+        return memory
+
+    def _snapshot(self, user_id: int) -> tuple:
+        # add() replaces the arrays and lists rather than changing them, so these stay as they are.
+        memory = self._users[user_id]
+        self._dirty.discard(user_id)
+        return memory['vectors'], memory['snippets']
+
+    def _write(self, user_id: int, vectors, snippets: List[str]):
+        os.makedirs(self.directory, exist_ok=True)
+        vectors_path, meta_path = self._paths(user_id)
+        # Write then rename, so a reader holding the old file mapped keeps a consistent copy.
+        with open(vectors_path + ".tmp", 'wb') as f:
+            np.save(f, np.ascontiguousarray(vectors))
+        with open(meta_path + ".tmp", 'w') as f:
+            json.dump({'embedder': self.embedder.name, 'snippets': snippets}, f)
+        os.replace(vectors_path + ".tmp", vectors_path)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def _delete(self, user_id: int):
+        for path in self._paths(user_id):
+            if os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    def _report_write(future: concurrent.futures.Future):
+        if future.exception() is not None:
+            print(f"Failed to save a long-term memory index: {future.exception()}")
+
+    async def flush(self):
+        loop = asyncio.get_running_loop()
+        for user_id in list(self._dirty):
+            if user_id not in self._users:
+                continue
+            try:
+                await loop.run_in_executor(self._executor, self._write, user_id, *self._snapshot(user_id))
+            except OSError as e:
+                self._dirty.add(user_id)
+                print(f"Failed to save the memory index for user {user_id}: {e}")
+
+    def start_flusher(self):
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(MEMORY_SAVE_INTERVAL)
+            await self.flush()
+
+    def save(self):
+        # For shutdown, once the event loop has stopped: let queued writes finish, then write the rest.
+        self._executor.shutdown(wait=True)
+        for user_id in list(self._dirty):
+            self._write(user_id, *self._snapshot(user_id))
+
+    async def add(self, user_id: int, text: str):
+        vector = (await self.embedder.embed([text]))[0]
+        memory = self._load(user_id)
+        # vstack copies the memory-mapped rows into RAM; the file is replaced on the next save.
+        memory['vectors'] = np.vstack([memory['vectors'], vector[None, :]])[-MEMORY_MAX_ENTRIES:]
+        memory['snippets'] = (memory['snippets'] + [text])[-MEMORY_MAX_ENTRIES:]
+        self._dirty.add(user_id)
+        self.counters['stored'] += 1
+
+    def add_in_background(self, user_id: int, prompt: str, reply: str):
+        task = asyncio.create_task(self.add(user_id, memory_snippet(prompt, reply)))
+        self._pending.setdefault(user_id, set()).add(task)
+        task.add_done_callback(lambda t: self._finish_add(user_id, t))
+
+    def _finish_add(self, user_id: int, task: asyncio.Task):
+        pending = self._pending.get(user_id)
+        if pending is not None:
+            pending.discard(task)
+            if not pending:
+                del self._pending[user_id]
+        if not task.cancelled() and task.exception() is not None:
+            self.counters['failures'] += 1
+            print(f"Failed to store a long-term memory: {task.exception()}")
+
+    async def search(self, user_id: int, query: str, k: int, exclude=frozenset()) -> List[str]:
+        # exclude holds snippets that are already in the prompt (the live history).
+        memory = self._load(user_id)
+        candidates = [i for i, snippet in enumerate(memory['snippets']) if snippet not in exclude]
+        if not candidates:
+            return []
+        self.counters['searches'] += 1
+        query_vector = (await self.embedder.embed([query]))[0]
+        vectors = memory['vectors'] if len(candidates) == len(memory['snippets']) else memory['vectors'][candidates]
+        scores = np.asarray(vectors @ query_vector)
+        top = np.argpartition(-scores, min(k, len(candidates)) - 1)[:k]
+        hits = [memory['snippets'][candidates[i]] for i in sorted(top, key=lambda i: -scores[i]) if scores[i] >= MEMORY_MIN_SCORE]
+        self.counters['recalled'] += len(hits)
+        return hits
+
+    async def forget(self, user_id: int):
+        # Stop any exchange still being embedded first, or it would be stored again right after.
+        pending = self._pending.pop(user_id, set())
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        self._users.pop(user_id, None)
+        self._dirty.discard(user_id)
+        # Queued behind any write of this user's index, so nothing recreates the files afterwards.
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._delete, user_id)
+
+    def stats(self) -> dict:
+        return {
+            'loaded_users': len(self._users),
+            'loaded_entries': sum(len(m['snippets']) for m in self._users.values()),
+            'unsaved_users': len(self._dirty),
+            **self.counters,
+        }
+
+LONG_TERM_MEMORY = MemoryIndex(MEMORY_DIR, GeminiEmbedder() if MEMORY_EMBEDDER == "gemini" else HashingEmbedder())
+
+async def recall_memories(user_id: int, prompt: str, history: list) -> Optional[str]:
+    if not MEMORY_ENABLED or not prompt:
+        return None
+    try:
+        hits = await LONG_TERM_MEMORY.search(user_id, prompt, MEMORY_TOP_K, exclude=live_snippets(history))
+    except Exception as e:
+        print(f"Long-term memory lookup failed for user {user_id}: {e}")
+        return None
+    if not hits:
+        return None
+    return MEMORY_NOTE_HEADER + "\n" + "\n\n".join(f"- {hit}" for hit in hits)
+
+def live_snippets(history: list) -> set:
+    # The memory snippets of the exchanges that are still in the history word for word.
+    # Compacted turns are gone from it, so their memories can be recalled again.
+    snippets = set()
+    for user_turn, model_turn in zip(history, history[1:]):
+        if user_turn.role == 'user' and model_turn.role == 'model':
+            prompt = " ".join(part.text for part in user_turn.parts if part.text)
+            reply = "".join(part.text for part in model_turn.parts if part.text)
+            snippets.add(memory_snippet(prompt, reply))
+    return snippets
+
+def strip_memory_note(history: list, memory_note: Optional[str]) -> list:
+    # The recalled snippets were only meant for this one call; don't keep them in the history.
+    if not memory_note or len(history) < 2:
+        return history
+    user_turn = history[-2]
+    parts = [part for part in user_turn.parts if part.text != memory_note]
+    return history[:-2] + [glm.Content(role=user_turn.role, parts=parts), history[-1]]
 
 # --- Game Storage ---
 active_connect_four_games = {}
@@ -652,9 +3005,71 @@ class GuessTheNumberInputModal(discord.ui.Modal, title="Guess The Number"):
             e.description = f"Your last guess was `{guess}`. The number is **{hint}**"
             await i.response.edit_message(embed=e)
 
+# --- MESSAGE DEBOUNCE ---
+# People often send three or four short messages in a row in the chat channel. Messages
+# from the same user in the same channel are gathered for CHAT_DEBOUNCE_SECONDS after
+# the latest one, then answered together: one prompt, one AI call, one reply to the
+# last message. A message that arrives before the burst's request has started
+# (while it is still waiting out the window, downloading images or queued in the
+# scheduler) cancels that request and restarts it with the new message included.
+CHAT_DEBOUNCE_SECONDS = float(os.getenv("CHAT_DEBOUNCE_SECONDS", 1.5))
+DEBOUNCE_STATS = {'bursts': 0, 'messages': 0, 'restarted': 0}
+chat_bursts = {}
+
+def queue_chat_message(message: discord.Message, prompt: str):
+    key = (message.channel.id, message.author.id)
+    burst = chat_bursts.get(key)
+    if burst is None:
+        burst = chat_bursts[key] = {'messages': [], 'task': None}
+    else:
+        burst['task'].cancel()
+        DEBOUNCE_STATS['restarted'] += 1
+    burst['messages'].append((message, prompt))
+    DEBOUNCE_STATS['messages'] += 1
+    burst['task'] = asyncio.create_task(flush_chat_burst(key, burst))
+
+async def flush_chat_burst(key, burst: dict):
+    await asyncio.sleep(CHAT_DEBOUNCE_SECONDS)
+
+    def close_burst():
+        # From here on a new message starts a new burst instead of cancelling this one.
+        if chat_bursts.get(key) is burst:
+            del chat_bursts[key]
+
+    messages = burst['messages']
+    prompt = "\n".join(p for _, p in messages if p)
+    attachments = [a for m, _ in messages for a in m.attachments if is_image_attachment(a)]
+    try:
+        await answer_chat_message(messages[-1][0], prompt, attachments, on_start=close_burst)
+    except Exception as e:
+        print(f"Failed to answer a chat message: {e}")
+    close_burst()
+    DEBOUNCE_STATS['bursts'] += 1
+
+async def answer_chat_message(message: discord.Message, prompt: str, attachments: List[discord.Attachment], on_start=None):
+    async with message.channel.typing():
+        pil_images = []
+        if attachments:
+            pil_images, errors = await load_image_attachments(attachments)
+            for e in errors:
+                print(f"Failed to process attachment: {e}")
+
+        try:
+            if STREAM_RESPONSES:
+                await stream_long_response(message, ask_aura_ai_stream(prompt, user_id=message.author.id, guild_id=message.guild.id, images=pil_images, mergeable=True, status_message=message, on_start=on_start))
+            else:
+                ai_response = await ask_aura_ai(prompt, user_id=message.author.id, guild_id=message.guild.id, images=pil_images, mergeable=True, status_message=message, on_start=on_start)
+                await send_long_response(message, ai_response)
+        except AIRequestMerged:
+            # Folded into the user's previous waiting message, which will answer both.
+            return
+
 @bot.event
 async def on_ready():
     load_data()
+    RESPONSE_CACHE.start_flusher()
+    if MEMORY_ENABLED:
+        LONG_TERM_MEMORY.start_flusher()
     try:
         synced = await bot.tree.sync()
         print(f"Synced {len(synced)} command(s)")
@@ -671,23 +3086,15 @@ async def on_message(message):
     is_mentioned = bot.user.mentioned_in(message)
 
     if is_in_chat_channel or is_mentioned:
-        async with message.channel.typing():
-            prompt = message.content.replace(f'<@!{bot.user.id}>', '').replace(f'<@{bot.user.id}>', '').strip()
-            if not prompt and is_mentioned:
-                await message.reply("You called? 😉")
-                return
+        prompt = message.content.replace(f'<@!{bot.user.id}>', '').replace(f'<@{bot.user.id}>', '').strip()
+        if not prompt and is_mentioned:
+            await message.reply("You called? 😉")
+            return
 
-            pil_images = []
-            if message.attachments:
-                for attachment in message.attachments:
-                    if attachment.content_type.startswith('image/'):
-                        try:
-                            pil_images.append(Image.open(io.BytesIO(await attachment.read())))
-                        except Exception as e:
-                            print(f"Failed to process attachment: {e}")
-            
-            ai_response = await ask_aura_ai(prompt, user_id=message.author.id, guild_id=message.guild.id, images=pil_images)
-            await send_long_response(message, ai_response)
+        if is_in_chat_channel and CHAT_DEBOUNCE_SECONDS > 0:
+            queue_chat_message(message, prompt)
+            return
+        await answer_chat_message(message, prompt, [a for a in message.attachments if is_image_attachment(a)])
 
 # --- PUBLIC SLASH COMMANDS ---
 
@@ -750,6 +3157,34 @@ async def mode_error(interaction: discord.Interaction, error: app_commands.AppCo
                 ephemeral=True
             )
 
+@bot.tree.command(name="model_policy", description="Chooses which AI model Aura uses in this server (Moderator or Owner only).")
+@app_commands.describe(policy="Auto picks per message; the others always use one model.")
+@app_commands.choices(policy=[
+    discord.app_commands.Choice(name="Auto (fast model for simple messages)", value="auto"),
+    discord.app_commands.Choice(name="Always Pro", value="pro"),
+    discord.app_commands.Choice(name="Always Flash", value="flash"),
+])
+@is_moderator_or_owner()
+async def model_policy(interaction: discord.Interaction, policy: discord.app_commands.Choice[str]):
+    guild_id_str = str(interaction.guild.id)
+    if guild_id_str not in server_configs:
+        server_configs[guild_id_str] = {}
+
+    server_configs[guild_id_str]['model_policy'] = policy.value
+    save_configs()
+
+    await interaction.response.send_message(f"Model policy set to **{policy.name}**.", ephemeral=True)
+
+@model_policy.error
+async def model_policy_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+    await mode_error(interaction, error)
+
+@bot.tree.command(name="forget_me", description="Makes Aura forget your conversation history and long-term memories.")
+async def forget_me(interaction: discord.Interaction):
+    conversation_history.pop(interaction.user.id)
+    await LONG_TERM_MEMORY.forget(interaction.user.id)
+    await interaction.response.send_message("Done! I've forgotten everything we talked about. 🧹", ephemeral=True)
+
 @bot.tree.command(name="prompt_maker", description="Get help creating a detailed image prompt from a simple idea.")
 @app_commands.describe(idea="Your simple idea (e.g., 'a cat in space').")
 async def prompt_maker(interaction: discord.Interaction, idea: str):
@@ -763,7 +3198,9 @@ async def prompt_maker(interaction: discord.Interaction, idea: str):
         f"Here is the user's idea: '{idea}'"
     )
     
-    ai_response = await ask_aura_ai(prompt_engineering_prompt, user_id=interaction.user.id, guild_id=interaction.guild.id)
+    ai_response = await ask_aura_ai_stateless(prompt_engineering_prompt, user_id=interaction.user.id, guild_id=interaction.guild.id, interaction=interaction)
+    if ai_response is None:
+        return
     
     embed = discord.Embed(
         title="🎨 Enhanced Image Prompt",
@@ -792,25 +3229,27 @@ async def ask_image(interaction: discord.Interaction,
     await interaction.response.defer(thinking=True)
     
     attachments = [img for img in [image1, image2, image3, image4, image5] if img is not None]
-    pil_images = []
 
     try:
-        for attachment in attachments:
-            pil_images.append(Image.open(io.BytesIO(await attachment.read())))
-
-        ai_response = await ask_aura_ai(
-            f"In a helpful and analytical tone, answer this question about the provided image(s): {prompt}",
-            user_id=interaction.user.id,
-            guild_id=interaction.guild.id,
-            images=pil_images
-        )
+        pil_images, errors = await load_image_attachments(attachments)
+        if errors:
+            raise errors[0]
+
+        image_prompt = f"In a helpful and analytical tone, answer this question about the provided image(s): {prompt}"
         
         embed = discord.Embed(title="🖼️ Image Analysis", color=discord.Color.teal())
         embed.set_image(url=image1.url)
         embed.set_footer(text=f"Analyzed {len(pil_images)} image(s).")
         
-        await send_long_response(interaction, ai_response, embed=embed)
+        if STREAM_RESPONSES:
+            await stream_long_response(interaction, ask_aura_ai_stream(image_prompt, user_id=interaction.user.id, guild_id=interaction.guild.id, images=pil_images, interaction=interaction, cache_analysis=True), embed=embed)
+        else:
+            ai_response = await ask_aura_ai(image_prompt, user_id=interaction.user.id, guild_id=interaction.guild.id, images=pil_images, interaction=interaction, cache_analysis=True)
+            if ai_response is not None:
+                await send_long_response(interaction, ai_response, embed=embed)
 
+    except AttachmentRejected as e:
+        await interaction.followup.send(f"Sorry, I can't analyze that: {e}.")
     except Exception as e:
         print(f"Error processing images: {e}")
         await interaction.followup.send("Sorry, I had trouble reading one of the image files. Please try again.")
@@ -820,27 +3259,39 @@ async def ask_image(interaction: discord.Interaction,
 async def plan_my_day(interaction: discord.Interaction, goals: str):
     await interaction.response.defer(thinking=True)
     prompt = f"Please create a simple, organized schedule based on these goals: '{goals}'. Suggest timings and add a positive, encouraging note at the end."
-    ai_response = await ask_aura_ai(prompt, user_id=interaction.user.id, guild_id=interaction.guild.id)
     embed = discord.Embed(title="✨ Here's a Plan for Your Day!", color=discord.Color.purple())
-    await send_long_response(interaction, ai_response, embed=embed)
+    if STREAM_RESPONSES:
+        await stream_long_response(interaction, ask_aura_ai_stateless_stream(prompt, user_id=interaction.user.id, guild_id=interaction.guild.id, interaction=interaction), embed=embed)
+    else:
+        ai_response = await ask_aura_ai_stateless(prompt, user_id=interaction.user.id, guild_id=interaction.guild.id, interaction=interaction)
+        if ai_response is not None:
+            await send_long_response(interaction, ai_response, embed=embed)
 
 @bot.tree.command(name="summarize", description="Aura will summarize a long piece of text for you.")
 @app_commands.describe(text="Paste the text or article link you want to summarize.")
 async def summarize(interaction: discord.Interaction, text: str):
     await interaction.response.defer(thinking=True)
     prompt = f"Please provide a concise, easy-to-read summary of the following text or webpage: '{text}'"
-    ai_response = await ask_aura_ai(prompt, user_id=interaction.user.id, guild_id=interaction.guild.id)
     embed = discord.Embed(title="📝 Here's a Summary!", color=discord.Color.blue())
-    await send_long_response(interaction, ai_response, embed=embed)
+    if STREAM_RESPONSES:
+        await stream_long_response(interaction, ask_aura_ai_stateless_stream(prompt, user_id=interaction.user.id, guild_id=interaction.guild.id, interaction=interaction), embed=embed)
+    else:
+        ai_response = await ask_aura_ai_stateless(prompt, user_id=interaction.user.id, guild_id=interaction.guild.id, interaction=interaction)
+        if ai_response is not None:
+            await send_long_response(interaction, ai_response, embed=embed)
 
 @bot.tree.command(name="brainstorm", description="Aura will help you brainstorm ideas on any topic.")
 @app_commands.describe(topic="What do you need ideas for?")
 async def brainstorm(interaction: discord.Interaction, topic: str):
     await interaction.response.defer(thinking=True)
     prompt = f"Please brainstorm a list of creative and interesting ideas for the following topic: '{topic}'"
-    ai_response = await ask_aura_ai(prompt, user_id=interaction.user.id, guild_id=interaction.guild.id)
     embed = discord.Embed(title=f"💡 Ideas for '{topic}'", color=discord.Color.gold())
-    await send_long_response(interaction, ai_response, embed=embed)
+    if STREAM_RESPONSES:
+        await stream_long_response(interaction, ask_aura_ai_stateless_stream(prompt, user_id=interaction.user.id, guild_id=interaction.guild.id, interaction=interaction), embed=embed)
+    else:
+        ai_response = await ask_aura_ai_stateless(prompt, user_id=interaction.user.id, guild_id=interaction.guild.id, interaction=interaction)
+        if ai_response is not None:
+            await send_long_response(interaction, ai_response, embed=embed)
 
 # --- PRIVILEGED SLASH COMMANDS ---
 
@@ -865,8 +3316,9 @@ async def date_night_error(interaction: discord.Interaction, error: app_commands
 async def pet_name(interaction: discord.Interaction, person: discord.Member):
     await interaction.response.defer(thinking=True)
     prompt = f"Generate a single, cute, and slightly funny pet name for my partner, {person.display_name}."
-    ai_response = await ask_aura_ai(prompt, user_id=interaction.user.id, guild_id=interaction.guild.id)
-    await interaction.followup.send(f"How about this for {person.mention}? ... **{ai_response}**")
+    ai_response = await ask_aura_ai(prompt, user_id=interaction.user.id, guild_id=interaction.guild.id, interaction=interaction)
+    if ai_response is not None:
+        await interaction.followup.send(f"How about this for {person.mention}? ... **{ai_response}**")
 @pet_name.error
 async def pet_name_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
     await handle_privileged_error(interaction, error)
@@ -995,6 +3447,180 @@ async def clear_my_notes(interaction: discord.Interaction):
 async def clear_my_notes_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
     await handle_privileged_error(interaction, error)
 
+# Discord rejects an embed with more than 25 fields, a field value over 1024
+# characters, or more than 6000 characters in all; the 6000 covers every embed in the
+# message. Lists that grow with the number of keys go in one field, cut at a whole line,
+# and the finished diagnostics are split into as many messages as they need.
+EMBED_FIELD_VALUE_LIMIT = 1024
+EMBED_MAX_FIELDS = 25
+EMBED_TOTAL_LIMIT = 6000
+
+def field_lines(lines: List[str]) -> str:
+    kept = []
+    for line in lines:
+        if len("\n".join(kept + [line])) + len(f"\n…and {len(lines)} more") > EMBED_FIELD_VALUE_LIMIT:
+            return "\n".join(kept + [f"…and {len(lines) - len(kept)} more"])
+        kept.append(line)
+    return "\n".join(kept)
+
+def paginate_embed(embed: discord.Embed) -> List[discord.Embed]:
+    pages = [discord.Embed(title=embed.title, color=embed.color)]
+    size = len(embed.title)
+    for field in embed.fields:
+        value = field.value if len(field.value) <= EMBED_FIELD_VALUE_LIMIT else field.value[:EMBED_FIELD_VALUE_LIMIT - 1] + "…"
+        if len(pages[-1].fields) >= EMBED_MAX_FIELDS or size + len(field.name) + len(value) > EMBED_TOTAL_LIMIT:
+            pages.append(discord.Embed(title=f"{embed.title} (continued)", color=embed.color))
+            size = len(pages[-1].title)
+        pages[-1].add_field(name=field.name, value=value, inline=field.inline)
+        size += len(field.name) + len(value)
+    return pages
+
+@bot.tree.command(name="aura_diagnostics", description="⭐ [PRIVATE] Show the health of Aura's API keys.")
+@is_privileged()
+async def aura_diagnostics(interaction: discord.Interaction):
+    embed = discord.Embed(title="🩺 Aura Diagnostics", color=THEME_COLOR_BLUE)
+    key_lines = []
+    for s in KEY_SCHEDULER.report():
+        status = f"⏳ cooling down ({s['cooldown_left']:.0f}s)" if s['cooldown_left'] else "✅"
+        key_lines.append(f"`{s['name']}` {status} | In flight: **{s['in_flight']}** | Requests: {s['requests']} | "
+                         f"Errors: {s['errors']} (429s: {s['rate_limited']}) | Recent: {s['error_rate']:.0%}")
+    embed.add_field(name="🔑 API Keys", value=field_lines(key_lines) or "No keys loaded.", inline=False)
+    fp = conversation_history.footprint()
+    embed.add_field(
+        name="💬 Conversation Store",
+        value=f"Sessions: **{fp['sessions']}**/{MAX_CHAT_SESSIONS} | Turns: **{fp['turns']}** | Size: **{fp['bytes'] / 1024:.1f} KiB**\n"
+              f"Evicted: {fp['evicted']} | Expired: {fp['expired']} | Trimmed turns: {fp['trimmed_turns']}",
+        inline=False
+    )
+    rc = RESPONSE_CACHE.stats()
+    embed.add_field(
+        name="🗃️ Response Cache",
+        value=f"Entries: **{rc['entries']}**/{RESPONSE_CACHE_MAX_ENTRIES} | Hit rate: **{rc['hit_rate']:.0%}** "
+              f"({rc['hits']} hits, {rc['misses']} misses) | Evicted: {rc['evicted']} | Expired: {rc['expired']}",
+        inline=False
+    )
+    mr = MODEL_ROUTER.stats()
+    model_lines = [
+        f"`{name}` p50 {m['p50'] or 0:.1f}s | p95 {m['p95'] or 0:.1f}s | errors {m['error_rate']:.0%}"
+        for name, m in sorted(mr['models'].items())
+    ]
+    route_lines = [f"{route}: {count}" for route, count in sorted(mr['routes'].items(), key=lambda kv: -kv[1])]
+    embed.add_field(
+        name="🧭 Model Routing",
+        value="\n".join(model_lines + route_lines) or "No requests routed yet.",
+        inline=False
+    )
+    lm = LONG_TERM_MEMORY.stats()
+    embed.add_field(
+        name="🧠 Long-Term Memory",
+        value=f"{'Enabled' if MEMORY_ENABLED else 'Disabled'} ({LONG_TERM_MEMORY.embedder.name} embedder) | "
+              f"Loaded users: **{lm['loaded_users']}** ({lm['loaded_entries']} entries, {lm['unsaved_users']} unsaved)\n"
+              f"Stored: {lm['stored']} | Searches: {lm['searches']} | Recalled: {lm['recalled']} | Failures: {lm['failures']}",
+        inline=False
+    )
+    ic = IMAGE_ANALYSIS_CACHE.stats()
+    embed.add_field(
+        name="🖼️ Image Analysis Cache",
+        value=f"Entries: **{ic['entries']}**/{IMAGE_ANALYSIS_CACHE_MAX_ENTRIES} | Hit rate: **{ic['hit_rate']:.0%}** "
+              f"({ic['hits']} hits, {ic['misses']} misses) | Evicted: {ic['evicted']} | Expired: {ic['expired']}",
+        inline=False
+    )
+    sf = AI_SINGLE_FLIGHT.stats()
+    embed.add_field(
+        name="🔗 Request Coalescing",
+        value=f"Upstream calls: **{sf['leaders']}** | Calls saved: **{sf['saved']}** | In flight: {sf['in_flight']} | Fallbacks: {sf['fallbacks']}",
+        inline=False
+    )
+    qs = AI_SCHEDULER.stats()
+    embed.add_field(
+        name="🚦 Request Scheduler",
+        value=f"Running: **{qs['running']}**/{AI_MAX_CONCURRENCY} | Waiting: **{qs['waiting']}** across {qs['guilds']} guild(s) | "
+              f"Avg wait: **{qs['avg_wait']:.2f}s**\nDispatched: {qs['dispatched']} (commands {qs['interaction_lane']}, chat {qs['chat_lane']}) | "
+              f"Merged: {qs['merged']} | Turned away: {qs['dropped']} | Expired: {qs['expired']}",
+        inline=False
+    )
+    timings = " | ".join(
+        f"{stage} {1000 * sum(IMAGE_STAGE_TIMINGS[stage]) / len(IMAGE_STAGE_TIMINGS[stage]):.0f}ms"
+        for stage in IMAGE_STAGES if IMAGE_STAGE_TIMINGS[stage]
+    ) or "no samples yet"
+    embed.add_field(
+        name="🖼️ Image Pipeline",
+        value=f"Processed: **{IMAGE_STATS['processed']}** | Rejected: {IMAGE_STATS['rejected']} | "
+              f"Bytes: {IMAGE_STATS['bytes_in'] / 1024:.0f} KiB → {IMAGE_STATS['bytes_out'] / 1024:.0f} KiB\nAvg stage time: {timings}",
+        inline=False
+    )
+    breakers = [s['breaker'].report() for s in KEY_SCHEDULER.stats.values()] + [b.report() for b in MODEL_BREAKERS.values()]
+    state_icons = {'closed': '🟢', 'half_open': '🟡', 'open': '🔴'}
+    embed.add_field(
+        name="🔌 Circuit Breakers",
+        value=field_lines([f"Retries: **{RETRY_STATS['retries']}** | Gave up: {RETRY_STATS['gave_up']}"] + [
+            f"{state_icons[b['state']]} `{b['name']}` {b['state']} | failures: {b['failures']} | opened: {b['opened']} | rejected: {b['rejected']}"
+            for b in breakers
+        ]),
+        inline=False
+    )
+    ds = DEBOUNCE_STATS
+    embed.add_field(
+        name="⏱️ Message Debounce",
+        value=f"Window: {CHAT_DEBOUNCE_SECONDS:.1f}s | Messages: **{ds['messages']}** → bursts answered: **{ds['bursts']}** | "
+              f"Restarted: {ds['restarted']} | Pending: {len(chat_bursts)}",
+        inline=False
+    )
+    ob = OUTBOUND.stats()
+    embed.add_field(
+        name="📤 Outbound Dispatcher",
+        value=f"Queued: **{ob['queued']}** in {ob['channels']} channel(s) | Rate buckets: {ob['buckets']} | Queue delay: avg {ob['avg_delay'] * 1000:.0f}ms, p95 {ob['p95_delay'] * 1000:.0f}ms\n"
+              f"Sent: {ob['sent']} | Edited: {ob['edited']} | Deleted: {ob['deleted']} | "
+              f"Coalesced edits: {ob['coalesced']} | Throttled: {ob['throttled']} | Skipped: {ob['skipped']}",
+        inline=False
+    )
+    ex = EXTRACTION_POOL.stats()
+    embed.add_field(
+        name="⛏️ Extraction Pool",
+        value=f"Workers: {ex['workers']}/{EXTRACTION_POOL.workers} | Running: **{ex['running']}** | Queued: **{ex['queued']}** (peak in flight {ex['max_in_flight']}) | "
+              f"Queue wait: avg {ex['avg_wait'] * 1000:.0f}ms | Run: p95 {ex['p95_run']:.1f}s\n"
+              f"Completed: {ex['completed']} | Failed: {ex['failed']} | Timed out: {ex['timed_out']} | Cancelled: {ex['cancelled']} | Workers recycled: {ex['recycled']}",
+        inline=False
+    )
+    tc = await TRACK_CACHE.stats()
+    embed.add_field(
+        name="🗃️ Track Cache",
+        value=f"Searches: **{tc['search_hits']}** hits / {tc['search_misses']} misses ({tc['searches']} stored) | "
+              f"Streams: **{tc['stream_hits']}** hits / {tc['stream_misses']} misses ({tc['streams']} stored)\n"
+              f"Spotify: **{tc['spotify_hits']}** hits / {tc['spotify_misses']} misses ({tc['spotify']} stored) | "
+              f"Expired: {tc['expired']} | Evicted: {tc['evicted']}",
+        inline=False
+    )
+    ps = PREFETCH_STATS
+    embed.add_field(
+        name="🎵 Track Prefetch",
+        value=f"Ahead: {PREFETCH_AHEAD} | Prefetched: **{ps['prefetched']}** (failed {ps['failed']}) | "
+              f"Ready on time: **{ps['hits']}** (waited {ps['waited']}) | Expired: {ps['expired']} | Resolved late: {ps['misses']}",
+        inline=False
+    )
+    hs = HEDGE_STATS
+    hedge_rate = hs['hedged'] / hs['requests'] if hs['requests'] else 0.0
+    embed.add_field(
+        name="🪁 Hedged Requests",
+        value=f"{'Enabled' if HEDGE_ENABLED else 'Disabled'} at p{HEDGE_PERCENTILE * 100:.0f} | Hedged: **{hs['hedged']}**/{hs['requests']} "
+              f"({hedge_rate:.0%}) | No free slot: {hs['skipped']} | Primary wins: {hs['primary_wins']} | Backup wins: {hs['backup_wins']} | Both failed: {hs['both_failed']}",
+        inline=False
+    )
+    cs = COMPACTION_STATS
+    embed.add_field(
+        name="🗜️ History Compaction",
+        value=f"Stored tokens: **{fp['tokens']}** | Runs: **{cs['runs']}** (failed {cs['failures']}, discarded {cs['discarded']}) | "
+              f"Tokens: {cs['tokens_before']} → {cs['tokens_after']}",
+        inline=False
+    )
+    first_page, *more_pages = paginate_embed(embed)
+    await interaction.response.send_message(embed=first_page, ephemeral=True)
+    for page in more_pages:
+        await interaction.followup.send(embed=page, ephemeral=True)
+@aura_diagnostics.error
+async def aura_diagnostics_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+    await handle_privileged_error(interaction, error)
+
 # --- MUSIC SLASH COMMANDS ---
 
 @bot.tree.command(name="join", description="Join your current voice channel")
@@ -1011,6 +3637,7 @@ async def join_command(interaction: discord.Interaction):
 async def leave_command(interaction: discord.Interaction):
     voice_client = interaction.guild.voice_client
     if voice_client:
+        cancel_playlist_loading(str(interaction.guild_id))
         await voice_client.disconnect()
         SONG_QUEUES.pop(str(interaction.guild_id), None)
         await interaction.response.send_message(embed=discord.Embed(title="👋 Disconnected", color=THEME_COLOR_YELLOW))
@@ -1029,64 +3656,105 @@ async def play_command(interaction: discord.Interaction, song_query: str):
     if not voice_client: voice_client = await voice_channel.connect()
     elif voice_client.channel != voice_channel: await voice_client.move_to(voice_channel)
 
-    song_queries = get_spotify_tracks(song_query) or [song_query]
+    song_queries = await get_spotify_tracks(song_query) or [song_query]
     guild_id = str(interaction.guild_id)
     if guild_id not in SONG_QUEUES: SONG_QUEUES[guild_id] = deque()
 
-    added_to_queue = []
-    for query in song_queries:
+    lookups = deque((query, asyncio.create_task(search_track(query))) for query in song_queries)
+    first_song, failed = None, 0
+    while lookups and first_song is None:
+        query, lookup = lookups.popleft()
         try:
-            ydl_opts = {"format": "bestaudio", "noplaylist": True, "quiet": True, "extract_flat": True, "cookiefile": "cookies.txt"}
-            results = await search_ytdlp_async(f"ytsearch1:{query}", ydl_opts)
-            if not results or not results.get('entries'): continue
-            video_info = results['entries'][0]
-            title = video_info.get("title", "Untitled")
-            webpage_url = video_info.get("url")
-            SONG_QUEUES[guild_id].append({'webpage_url': webpage_url, 'title': title})
-            added_to_queue.append(title)
+            first_song = await lookup
         except Exception as e:
-            await interaction.channel.send(embed=discord.Embed(title="❌ Fetch Error", description=f"Could not fetch '{query}'.\n`{e}`", color=discord.Color.red()))
+            if len(song_queries) == 1:
+                await OUTBOUND.send(interaction.channel, embed=discord.Embed(title="❌ Fetch Error", description=f"Could not fetch '{query}'.\n`{e}`", color=discord.Color.red()))
+            else:
+                print(f"Could not fetch '{query}': {e}")
+        if first_song is None:
+            failed += 1
 
-    if not added_to_queue:
+    if first_song is None:
         return await interaction.followup.send(embed=discord.Embed(title="❌ No Results", description="Could not find any playable songs.", color=discord.Color.red()))
 
-    first_song_title = added_to_queue[0]
-    if voice_client.is_playing() or voice_client.is_paused():
-        desc = f"Added **{len(added_to_queue)}** songs." if len(added_to_queue) > 1 else f"**{first_song_title}**"
-        await interaction.followup.send(embed=discord.Embed(title="✅ Added to Queue", description=desc, color=THEME_COLOR_BLUE))
+    SONG_QUEUES[guild_id].append(first_song)
+    already_playing = voice_client.is_playing() or voice_client.is_paused()
+    if len(song_queries) > 1:
+        progress = {'first': first_song['title'], 'queued': 1, 'failed': failed, 'total': len(song_queries)}
+        status_message = await OUTBOUND.followup(interaction, embed=playlist_status_embed(progress, finished=not lookups))
+    elif already_playing:
+        await interaction.followup.send(embed=discord.Embed(title="✅ Added to Queue", description=f"**{first_song['title']}**", color=THEME_COLOR_BLUE))
+    else:
+        await interaction.followup.send(embed=discord.Embed(title="🎵 Let's begin!", description=f"Queued up **{first_song['title']}**.", color=THEME_COLOR_YELLOW))
+
+    # Start loading the rest first, so a first track that fails to play doesn't hold it up.
+    if lookups:
+        start_playlist_loading(guild_id, voice_client, guild_id, interaction.channel, lookups, status_message, progress)
+    if already_playing:
+        prefetch_upcoming(guild_id)
     else:
-        await interaction.followup.send(embed=discord.Embed(title="🎵 Let's begin!", description=f"Queued up **{first_song_title}**.", color=THEME_COLOR_YELLOW))
         await play_next_song(voice_client, guild_id, interaction.channel)
 
 async def play_next_song(voice_client, guild_id, channel):
-    if guild_id in NOW_PLAYING_MESSAGES and NOW_PLAYING_MESSAGES[guild_id]:
-        try: await NOW_PLAYING_MESSAGES[guild_id].delete()
-        except discord.NotFound: pass
-    
-    if guild_id in SONG_QUEUES and SONG_QUEUES[guild_id]:
-        song_data = SONG_QUEUES[guild_id].popleft()
-        title, webpage_url = song_data['title'], song_data['webpage_url']
-        try:
-            stream_opts = {"format": "bestaudio", "quiet": True, "cookiefile": "cookies.txt"}
-            stream_results = await search_ytdlp_async(webpage_url, stream_opts)
-            audio_url = stream_results['url']
-            ffmpeg_options = {"before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5", "options": "-vn"}
-            
-            guild_volume = GUILD_VOLUMES.get(guild_id, 0.5) # Default to 50%
-            source = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(audio_url, **ffmpeg_options), volume=guild_volume)
-            
-            voice_client.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(play_next_song(voice_client, guild_id, channel), bot.loop))
+    # The end-of-track callback, /play and a loading playlist can all try to start the next
+    # song. Whoever gets here first pops and plays it; the others find it starting or
+    # playing and leave the queue alone.
+    if guild_id in PLAYBACK_STARTING or voice_client.is_playing() or voice_client.is_paused():
+        return
+    PLAYBACK_STARTING.add(guild_id)
+    try:
+        # Start the next song before touching the old Now Playing message so there is no gap.
+        previous_message = NOW_PLAYING_MESSAGES.pop(guild_id, None)
+        while SONG_QUEUES.get(guild_id):
+            song_data = SONG_QUEUES[guild_id].popleft()
+            title = song_data['title']
+            try:
+                audio_url = await get_stream_url(song_data)
+                guild_volume = GUILD_VOLUMES.get(guild_id, 0.5) # Default to 50%
+                source = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(audio_url, **FFMPEG_OPTIONS), volume=guild_volume)
+                
+                voice_client.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(play_next_song(voice_client, guild_id, channel), bot.loop))
+            except Exception as e:
+                await OUTBOUND.send(channel, embed=discord.Embed(title="❌ Playback Error", description=f"Could not play '{title}'. Skipping.\n`{e}`", color=discord.Color.red()))
+                continue
+            cancel_idle_disconnect(guild_id)
+            prefetch_upcoming(guild_id)
+            if previous_message:
+                try: await OUTBOUND.delete(previous_message)
+                except discord.NotFound: pass
             
             embed = discord.Embed(title="🎶 Now Playing", description=f"**{title}**", color=THEME_COLOR_YELLOW)
-            NOW_PLAYING_MESSAGES[guild_id] = await channel.send(embed=embed, view=MusicControls(bot))
-        except Exception as e:
-            await channel.send(embed=discord.Embed(title="❌ Playback Error", description=f"Could not play '{title}'. Skipping.\n`{e}`", color=discord.Color.red()))
-            await play_next_song(voice_client, guild_id, channel)
-    else:
-        await asyncio.sleep(180)
-        if voice_client.is_connected() and not voice_client.is_playing():
-            await voice_client.disconnect()
-            NOW_PLAYING_MESSAGES.pop(guild_id, None)
+            NOW_PLAYING_MESSAGES[guild_id] = await OUTBOUND.send(channel, embed=embed, view=MusicControls(bot))
+            return
+    finally:
+        PLAYBACK_STARTING.discard(guild_id)
+
+    if previous_message:
+        try: await OUTBOUND.delete(previous_message)
+        except discord.NotFound: pass
+    schedule_idle_disconnect(voice_client, guild_id)
+
+# The queue ran dry: leave the voice channel after IDLE_DISCONNECT_SECONDS unless
+# something starts playing first. It runs as its own task so nobody who started
+# playback waits on it.
+def schedule_idle_disconnect(voice_client, guild_id):
+    cancel_idle_disconnect(guild_id)
+    task = asyncio.create_task(disconnect_when_idle(voice_client, guild_id))
+    IDLE_DISCONNECT_TASKS[guild_id] = task
+    task.add_done_callback(lambda _: IDLE_DISCONNECT_TASKS.pop(guild_id, None) if IDLE_DISCONNECT_TASKS.get(guild_id) is task else None)
+
+def cancel_idle_disconnect(guild_id):
+    task = IDLE_DISCONNECT_TASKS.pop(guild_id, None)
+    if task is not None:
+        task.cancel()
+
+async def disconnect_when_idle(voice_client, guild_id):
+    await asyncio.sleep(IDLE_DISCONNECT_SECONDS)
+    if playlist_tasks.get(guild_id) or SONG_QUEUES.get(guild_id):
+        return
+    if voice_client.is_connected() and not voice_client.is_playing() and not voice_client.is_paused():
+        await voice_client.disconnect()
+        NOW_PLAYING_MESSAGES.pop(guild_id, None)
 
 
 @bot.tree.command(name="ping", description="Check the bot's latency.")
@@ -1172,10 +3840,14 @@ async def help(i):
 
 
 # --- RUN THE BOT ---
-if DISCORD_TOKEN is None:
-    print("Error: DISCORD_BOT_TOKEN not found in .env file.")
-else:
-    try:
-        bot.run(DISCORD_TOKEN)
-    except discord.errors.LoginFailure:
-        print("Error: Improper token has been passed. Please check your DISCORD_BOT_TOKEN.")
+if __name__ == "__main__":
+    if DISCORD_TOKEN is None:
+        print("Error: DISCORD_BOT_TOKEN not found in .env file.")
+    else:
+        try:
+            bot.run(DISCORD_TOKEN)
+        except discord.errors.LoginFailure:
+            print("Error: Improper token has been passed. Please check your DISCORD_BOT_TOKEN.")
+        finally:
+            RESPONSE_CACHE.save()
+            LONG_TERM_MEMORY.save()